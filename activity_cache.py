@@ -0,0 +1,51 @@
+import json
+import time
+from contextlib import closing
+import config
+import storage
+
+
+class ActivityCache:
+    """On-disk cache of raw Strava activity details, keyed by activity id"""
+
+    def __init__(self, path=None, ttl_hours=None, max_entries=None):
+        self.path = path
+        self.ttl_seconds = (config.ACTIVITY_CACHE_TTL_HOURS if ttl_hours is None else ttl_hours) * 3600
+        self.max_entries = config.ACTIVITY_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS activity_cache (
+                    activity_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    fetched_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS activity_cache_fetched_at ON activity_cache (fetched_at)")
+
+    def get(self, activity_id):
+        """Get the cached activity JSON, or None if missing or older than the TTL"""
+        with closing(storage.connect(self.path)) as conn:
+            row = conn.execute(
+                "SELECT data FROM activity_cache WHERE activity_id = ? AND fetched_at >= ?",
+                (activity_id, time.time() - self.ttl_seconds)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, activity_id, data):
+        """Store the activity JSON returned by the API"""
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO activity_cache (activity_id, data, fetched_at) VALUES (?, ?, ?)",
+                (activity_id, json.dumps(data), time.time())
+            )
+
+    def evict(self):
+        """Drop expired entries, then the oldest ones beyond max_entries"""
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("DELETE FROM activity_cache WHERE fetched_at < ?",
+                         (time.time() - self.ttl_seconds,))
+            conn.execute("""
+                DELETE FROM activity_cache WHERE activity_id NOT IN (
+                    SELECT activity_id FROM activity_cache ORDER BY fetched_at DESC LIMIT ?
+                )
+            """, (self.max_entries,))
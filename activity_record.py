@@ -0,0 +1,135 @@
+from datetime import datetime, timezone
+
+
+# Unit conversions from the metric values Strava returns
+METERS_TO_MILES = 0.000621371
+METERS_TO_YARDS = 1.09361
+METERS_TO_FEET = 3.28084
+
+
+def _parse_time(value, local=False):
+    """Parse a Strava timestamp; start_date_local carries a 'Z' but is wall-clock time"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed.replace(tzinfo=None) if local else parsed.astimezone(timezone.utc)
+
+
+class _lazy:
+    """Like functools.cached_property, but memoizes into a __slots__ slot"""
+
+    def __init__(self, func):
+        self.func = func
+        self.slot = '_' + func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            value = self.func(obj)
+            setattr(obj, self.slot, value)
+            return value
+
+
+class ActivityRecord:
+    """Slim view of a Strava activity holding only the fields the cards use.
+
+    Distances are metres and times seconds, as Strava sends them; derived
+    metrics (miles, pace, ...) are computed on first use and memoized.
+    """
+
+    __slots__ = (
+        'id', 'name', 'type', 'start_date', 'start_date_local', 'distance', 'moving_time',
+        'elapsed_time', 'total_elevation_gain', 'average_heartrate', 'max_heartrate',
+        'calories', 'description', 'photo_url', 'total_photo_count', 'athlete_id',
+        # Memo slots for the _lazy properties below
+        '_miles', '_yards', '_feet', '_pace_seconds', '_speed_mph', '_moving_time_text',
+    )
+
+    def __init__(self, id, name, type, start_date, start_date_local, distance=0.0, moving_time=0,
+                 elapsed_time=0, total_elevation_gain=0.0, average_heartrate=None,
+                 max_heartrate=None, calories=None, description=None, photo_url=None,
+                 total_photo_count=0, athlete_id=None):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.start_date = start_date
+        self.start_date_local = start_date_local
+        self.distance = distance
+        self.moving_time = moving_time
+        self.elapsed_time = elapsed_time
+        self.total_elevation_gain = total_elevation_gain
+        self.average_heartrate = average_heartrate
+        self.max_heartrate = max_heartrate
+        self.calories = calories
+        self.description = description
+        self.photo_url = photo_url
+        self.total_photo_count = total_photo_count
+        self.athlete_id = athlete_id
+
+    @classmethod
+    def from_json(cls, data):
+        """Build a record straight from the activity JSON returned by the Strava API"""
+        photo_url = None
+        primary = (data.get('photos') or {}).get('primary')
+        if primary and primary.get('urls'):
+            photo_url = primary['urls'].get('600') or primary['urls'].get('1000')
+        return cls(
+            id=data['id'],
+            name=data.get('name') or '',
+            type=data.get('type') or data.get('sport_type') or 'Workout',
+            start_date=_parse_time(data.get('start_date')),
+            start_date_local=_parse_time(data.get('start_date_local'), local=True),
+            distance=float(data.get('distance') or 0),
+            moving_time=int(data.get('moving_time') or 0),
+            elapsed_time=int(data.get('elapsed_time') or 0),
+            total_elevation_gain=float(data.get('total_elevation_gain') or 0),
+            average_heartrate=data.get('average_heartrate'),
+            max_heartrate=data.get('max_heartrate'),
+            calories=data.get('calories'),
+            description=data.get('description'),
+            photo_url=photo_url,
+            total_photo_count=data.get('total_photo_count') or 0,
+            athlete_id=(data.get('athlete') or {}).get('id'),
+        )
+
+    @property
+    def is_swim(self):
+        return self.type == 'Swim'
+
+    @_lazy
+    def miles(self):
+        return self.distance * METERS_TO_MILES
+
+    @_lazy
+    def yards(self):
+        return self.distance * METERS_TO_YARDS
+
+    @_lazy
+    def feet(self):
+        """Elevation gain in feet"""
+        return self.total_elevation_gain * METERS_TO_FEET
+
+    @_lazy
+    def pace_seconds(self):
+        """Seconds per 100 yd for swims, per mile otherwise (0 without distance)"""
+        if self.is_swim:
+            return self.moving_time / self.yards * 100 if self.yards > 0 else 0
+        return self.moving_time / self.miles if self.miles > 0 else 0
+
+    @_lazy
+    def speed_mph(self):
+        return self.miles / (self.moving_time / 3600) if self.moving_time > 0 else 0
+
+    @_lazy
+    def moving_time_text(self):
+        """Moving time as '1h 2m 3s' (or '2m 3s' under an hour)"""
+        hours = self.moving_time // 3600
+        minutes = (self.moving_time % 3600) // 60
+        seconds = self.moving_time % 60
+        if hours > 0:
+            return f"{hours}h {minutes}m {seconds}s"
+        return f"{minutes}m {seconds}s"
@@ -0,0 +1,79 @@
+import json
+import time
+from contextlib import closing
+from activity_record import ActivityRecord
+import storage
+
+# Callbacks for activities stored by this process (the team stats, once loaded)
+_listeners = []
+
+
+def add_listener(callback):
+    """Call callback(athlete, summaries) after each put_many in this process"""
+    _listeners.append(callback)
+
+
+class ActivityStore:
+    """Local archive of athletes' summary activities, filled by runs and backfills.
+
+    Unlike the activity cache, entries never expire: this is the history that
+    team stats and leaderboards are computed from.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS activities (
+                    activity_id INTEGER PRIMARY KEY,
+                    athlete TEXT NOT NULL,
+                    start_date REAL NOT NULL,
+                    data TEXT NOT NULL,
+                    stored_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS activities_athlete_start ON activities (athlete, start_date)")
+            conn.execute("CREATE INDEX IF NOT EXISTS activities_start ON activities (start_date)")
+
+    def put_many(self, athlete, summaries):
+        """Store (or update) summary activity JSON from the API, in one transaction.
+        
+        Returns the start time (epoch seconds) of the newest one, None if there were none.
+        """
+        now = time.time()
+        rows = [(summary['id'], str(athlete), ActivityRecord.from_json(summary).start_date.timestamp(),
+                 json.dumps(summary), now) for summary in summaries]
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO activities (activity_id, athlete, start_date, data, stored_at) "
+                "VALUES (?, ?, ?, ?, ?)", rows
+            )
+        for callback in _listeners:
+            callback(athlete, summaries)
+        return max((row[2] for row in rows), default=None)
+
+    def count(self, athlete=None):
+        """Number of stored activities (for one athlete, or everyone)"""
+        with closing(storage.connect(self.path)) as conn:
+            if athlete is None:
+                return conn.execute("SELECT COUNT(*) FROM activities").fetchone()[0]
+            return conn.execute("SELECT COUNT(*) FROM activities WHERE athlete = ?",
+                                (str(athlete),)).fetchone()[0]
+
+    def iter_activities(self, athlete=None, since=None, until=None, stored_since=None):
+        """Lazily yield stored activities as (athlete, ActivityRecord), oldest first.
+
+        since and until are UTC datetimes bounding the start time; stored_since (epoch
+        seconds) limits it to activities stored or updated since then.
+        """
+        query = "SELECT athlete, data FROM activities WHERE start_date >= ? AND start_date < ?"
+        params = [since.timestamp() if since else 0, until.timestamp() if until else float('inf')]
+        if athlete is not None:
+            query += " AND athlete = ?"
+            params.append(str(athlete))
+        if stored_since is not None:
+            query += " AND stored_at >= ?"
+            params.append(stored_since)
+        with closing(storage.connect(self.path)) as conn:
+            for athlete_key, data in conn.execute(query + " ORDER BY start_date", params):
+                yield athlete_key, ActivityRecord.from_json(json.loads(data))
@@ -2,19 +2,24 @@
 """
 Helper script to authenticate with Strava and get a refresh token.
 Run this once to authorize the app and save your refresh token.
+
+Run with --team to enroll an athlete into the team token store instead;
+run it once per athlete (each athlete authorizes with their own Strava login).
 """
 
-import json
+import sys
 from stravalib.client import Client
 from flask import Flask, request
 import webbrowser
 import config
 import threading
 import time
+from token_store import TokenFile, TokenStore
 
 app = Flask(__name__)
 client = Client()
 token_data = {}
+team_mode = False
 
 
 @app.route('/authorization')
@@ -39,9 +44,11 @@ def authorization():
             'expires_at': token_response['expires_at']
         }
         
+        if team_mode:
+            return enroll_athlete(token_data)
+        
         # Save to file
-        with open(config.TOKEN_FILE, 'w') as f:
-            json.dump(token_data, f, indent=2)
+        TokenFile().save(token_data)
         
         return f"""
         <html>
@@ -60,6 +67,27 @@ def authorization():
         return f"Error exchanging code for token: {str(e)}", 500
 
 
+def enroll_athlete(token_data):
+    """Add the athlete who just authorized to the team token store"""
+    client.access_token = token_data['access_token']
+    athlete = client.get_athlete()
+    athlete_name = f"{athlete.firstname} {athlete.lastname}".strip()
+    TokenStore().save(athlete.id, token_data, name=athlete_name)
+    print(f"\n✓ Enrolled {athlete_name} (athlete {athlete.id}) in {config.ATHLETE_TOKEN_FILE}")
+    
+    return f"""
+        <html>
+            <body style="font-family: Arial; padding: 40px; text-align: center;">
+                <h1 style="color: #FC4C02;">✓ {athlete_name} Enrolled!</h1>
+                <p>Your activities will now be posted by the team bot.</p>
+                <p>Tokens saved to <code>{config.ATHLETE_TOKEN_FILE}</code></p>
+                <p style="color: #666; margin-top: 40px;">You can close this window now.
+                To enroll another athlete, run <code>auth_helper.py --team</code> again.</p>
+            </body>
+        </html>
+        """
+
+
 def shutdown_server():
     """Shutdown the Flask server after a delay"""
     time.sleep(3)
@@ -75,12 +103,17 @@ def shutdown_server():
 
 def main():
     """Main function to start the authorization flow"""
+    global team_mode
+    team_mode = '--team' in sys.argv[1:]
+    
     if not config.STRAVA_CLIENT_ID or not config.STRAVA_CLIENT_SECRET:
         print("ERROR: Please set STRAVA_CLIENT_ID and STRAVA_CLIENT_SECRET in your .env file first!")
         return
     
     print("="*60)
     print("Strava Authorization Helper")
+    if team_mode:
+        print("MODE: TEAM (enrolling an athlete)")
     print("="*60)
     print("\nThis will open your browser to authorize the application.")
     print("After authorization, you'll be redirected back here.\n")
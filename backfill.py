@@ -0,0 +1,162 @@
+"""
+Historical backfill: imports athletes' past activities into the local activity
+store (for team stats and leaderboards), without posting anything.
+
+    python3 main.py --backfill                          # Everyone's whole history
+    python3 main.py --backfill --since 2022-01-01 --until 2024-01-01
+    python3 main.py --backfill --athlete 12345          # One team member
+
+History is paged oldest first, 200 summary activities per request (years of an
+athlete's history take a handful of requests), and each page is stored and
+checkpointed as it arrives. When the Strava rate-limit budget runs out the
+backfill stops; running the same command again resumes where it left off.
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timezone
+import config
+import log
+import storage
+from activity_store import ActivityStore
+from rate_governor import BACKFILL, BudgetExhausted, governor
+from strava_client import SUMMARY_PAGE_SIZE, get_client
+from token_store import TokenStore
+
+# Strava launched in 2009: nothing started before this
+EARLIEST = datetime(2009, 1, 1, tzinfo=timezone.utc)
+
+
+class BackfillCheckpoint:
+    """How far each athlete's backfill of a date range got, so an interrupted one resumes"""
+
+    def __init__(self, path=None):
+        self.path = path
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS backfill_progress (
+                    athlete TEXT NOT NULL,
+                    since REAL NOT NULL,
+                    until REAL NOT NULL,
+                    after REAL NOT NULL,
+                    stored INTEGER NOT NULL,
+                    done INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (athlete, since, until)
+                )
+            """)
+
+    @staticmethod
+    def _range(since, until):
+        # An open-ended range is stored as until = 0
+        return since.timestamp(), until.timestamp() if until else 0
+
+    def get(self, athlete, since, until):
+        """(after, stored, done) for a backfill range, or None if it never started"""
+        with closing(storage.connect(self.path)) as conn:
+            row = conn.execute(
+                "SELECT after, stored, done FROM backfill_progress WHERE athlete = ? AND since = ? AND until = ?",
+                (str(athlete),) + self._range(since, until)
+            ).fetchone()
+        return (row[0], row[1], bool(row[2])) if row else None
+
+    def save(self, athlete, since, until, after, stored, done):
+        """Record that everything up to `after` (epoch seconds) is stored"""
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO backfill_progress (athlete, since, until, after, stored, done, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(athlete),) + self._range(since, until) + (after, stored, done, time.time())
+            )
+
+
+def backfill_athlete(strava, store, checkpoint, since, until=None):
+    """Store one athlete's activities that started between since and until (UTC datetimes).
+
+    Returns the number stored so far for the range. Raises BudgetExhausted when the
+    rate-limit budget runs out; the checkpoint keeps every page already stored.
+    """
+    key = strava.sync_key
+    progress = checkpoint.get(key, since, until)
+    # An open-ended range is never finished: running it again picks up newer activities
+    if progress and progress[2] and until is not None:
+        log.info(f"Athlete {key}: already backfilled ({progress[1]} activity(ies))", athlete=key)
+        return progress[1]
+    after, stored = progress[:2] if progress else (since.timestamp(), 0)
+    if progress:
+        log.info(f"Athlete {key}: resuming backfill from "
+                 f"{datetime.fromtimestamp(after, timezone.utc):%Y-%m-%d}", athlete=key)
+
+    # Backfill pages only use what the regular runs leave of the rate-limit budget
+    last_ids = set()
+    with governor.priority(BACKFILL):
+        while True:
+            page = strava.get_summary_page(datetime.fromtimestamp(after, timezone.utc), before=until)
+            newest = store.put_many(key, page)
+            stored += sum(1 for summary in page if summary['id'] not in last_ids)
+            last_ids = {summary['id'] for summary in page}
+            # Pages come oldest first, so the next one starts at the newest stored. Strava's
+            # `after` is exclusive: asking from a second earlier also gets any other activity
+            # that started in that second (re-storing the overlap is harmless), unless the
+            # whole page started within it
+            if newest is not None:
+                after = newest - 1 if newest - 1 > after else newest
+            done = len(page) < SUMMARY_PAGE_SIZE
+            checkpoint.save(key, since, until, after, stored, done)
+            if page:
+                log.info(f"Athlete {key}: {stored} activity(ies) stored, up to "
+                         f"{datetime.fromtimestamp(after, timezone.utc):%Y-%m-%d}", athlete=key,
+                         stored=stored)
+            if done:
+                return stored
+
+
+def run(since=None, until=None, athlete_id=None):
+    """Backfill every enrolled athlete (or one, or the single-athlete token); True if all finished"""
+    since = since or EARLIEST
+    store = ActivityStore()
+    checkpoint = BackfillCheckpoint()
+    token_store = TokenStore()
+    athlete_ids = [athlete_id] if athlete_id else token_store.athlete_ids()
+
+    log.banner(f"Backfilling {since:%Y-%m-%d} to {f'{until:%Y-%m-%d}' if until else 'now'}",
+               f"Athletes: {len(athlete_ids) if athlete_ids else 1}")
+
+    def backfill_one(athlete_id):
+        try:
+            strava = get_client(athlete_id, token_store=token_store) if athlete_id else get_client()
+            backfill_athlete(strava, store, checkpoint, since, until)
+            return True
+        except BudgetExhausted as e:
+            log.warning(f"Paused backfill for athlete {athlete_id or 'self'}: {str(e)} - run the same "
+                        f"command again to resume", athlete_id=athlete_id)
+        except Exception as e:
+            log.error(f"✗ Backfill failed for athlete {athlete_id or 'self'}: {str(e)}", athlete_id=athlete_id)
+        return False
+
+    workers = max(1, min(config.ATHLETE_WORKERS, len(athlete_ids)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        finished = list(executor.map(backfill_one, athlete_ids or [None]))
+
+    if all(finished):
+        log.banner(f"✓ Backfill complete: {store.count()} activity(ies) stored")
+    else:
+        log.banner(f"Backfill incomplete for {finished.count(False)} athlete(s); "
+                   f"{store.count()} activity(ies) stored so far", level='warning')
+    return all(finished)
+
+
+def _date(value):
+    return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='main.py --backfill', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--since', type=_date, help='first day to import (YYYY-MM-DD, UTC)')
+    parser.add_argument('--until', type=_date, help='day to stop before (YYYY-MM-DD, UTC; default: now)')
+    parser.add_argument('--athlete', help='only this enrolled athlete id')
+    args = parser.parse_args(argv)
+    return 0 if run(since=args.since, until=args.until, athlete_id=args.athlete) else 1
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Benchmark: render + serialize cost per activity card.
+
+Compares the previous approach (build the nested card dict by hand, then
+json.dumps it as requests did) with the template-compiled CardRenderer.
+
+    python3 benchmarks/bench_card_render.py [number_of_activities]
+"""
+
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from activity_record import ActivityRecord  # noqa: E402
+from card_renderer import CardRenderer, LAYOUTS, default_layout, orjson  # noqa: E402
+
+
+def make_activities(count):
+    types = ['Run', 'Ride', 'Swim', 'Walk', 'Hike', 'WeightTraining']
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [
+        ActivityRecord(
+            id=10_000_000 + i,
+            name=f"Morning {types[i % len(types)]} #{i}",
+            type=types[i % len(types)],
+            start_date=start + timedelta(hours=i),
+            start_date_local=(start + timedelta(hours=i)).replace(tzinfo=None),
+            distance=1000.0 + i % 20000,
+            moving_time=600 + i % 7200,
+            elapsed_time=700 + i % 7200,
+            total_elevation_gain=float(i % 300),
+            average_heartrate=120 + i % 50,
+            max_heartrate=160 + i % 30,
+            calories=200 + i % 900,
+            description="Felt great" if i % 4 == 0 else None,
+            photo_url="https://dgtzuqphqg23d.cloudfront.net/photo-600x450.jpg" if i % 5 == 0 else None,
+        )
+        for i in range(count)
+    ]
+
+
+def legacy_card(activity, athlete_name):
+    """The hand-built dict the bot used before CardRenderer"""
+    date_str = activity.start_date_local.strftime('%A, %B %d, %Y')
+    time_str = activity.start_date_local.strftime('%I:%M %p')
+    facts = LAYOUTS.get(activity.type, default_layout)(activity)
+    card = {
+        "type": "message",
+        "attachments": [
+            {
+                "contentType": "application/vnd.microsoft.card.adaptive",
+                "content": {
+                    "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+                    "type": "AdaptiveCard",
+                    "version": "1.4",
+                    "body": []
+                }
+            }
+        ]
+    }
+    body = card["attachments"][0]["content"]["body"]
+    if activity.photo_url:
+        body.append({"type": "Image", "url": activity.photo_url, "size": "Stretch"})
+    body.append({"type": "TextBlock", "text": activity.name, "size": "Large", "weight": "Bolder"})
+    body.append({"type": "TextBlock", "text": f"by {athlete_name}", "size": "Small", "weight": "Lighter",
+                 "color": "Accent", "spacing": "None"})
+    body.append({"type": "TextBlock", "text": f"{date_str} at {time_str}", "size": "Small",
+                 "color": "Default", "spacing": "None"})
+    body.append({"type": "TextBlock", "text": activity.type, "size": "Small", "weight": "Lighter",
+                 "spacing": "None"})
+    if facts:
+        body.append({"type": "FactSet", "facts": facts, "spacing": "Medium"})
+    if activity.description:
+        body.append({"type": "TextBlock", "text": activity.description, "wrap": True, "spacing": "Medium"})
+    body.append({"type": "ActionSet", "actions": [{
+        "type": "Action.OpenUrl", "title": "View on Strava",
+        "url": f"https://www.strava.com/activities/{activity.id}"}]})
+    return card
+
+
+def timed(label, func, activities, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for activity in activities:
+            func(activity)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    per_card_us = best / len(activities) * 1e6
+    print(f"{label:<40} {per_card_us:8.2f} µs/card  {len(activities) / best:10.0f} cards/s")
+    return per_card_us
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    activities = make_activities(count)
+    renderer = CardRenderer()
+
+    print(f"{count} activities, encoder: {'orjson' if orjson else 'stdlib json'}\n")
+    legacy = timed("dict + json.dumps (previous)",
+                   lambda a: json.dumps(legacy_card(a, "Pat Athlete")).encode('utf-8'), activities)
+    compiled = timed("CardRenderer.card (templates)",
+                     lambda a: renderer.card(a, athlete_name="Pat Athlete"), activities)
+    print(f"\nSpeedup: {legacy / compiled:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
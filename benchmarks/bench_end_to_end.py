@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark: runs main.post_activities against a local stand-in Strava
+API and Teams webhook and reports wall time, API calls, posts per second and
+peak RSS. Each size runs in a fresh process (and a fresh temporary working
+directory, so tokens and the state database start empty).
+
+    python3 benchmarks/bench_end_to_end.py                  # 1, 100 and 10000 activities
+    python3 benchmarks/bench_end_to_end.py 500 --strava-latency 0.05 --throttle-rate 0.05
+    python3 benchmarks/bench_end_to_end.py 100 --teams-rate 4 --channels 3   # fan-out
+    python3 benchmarks/bench_end_to_end.py 20000 --athletes 2000 --shards 4   # sharded team
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def run_once(args):
+    """Run one benchmark in this process and print the result as JSON"""
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    from fake_services import FakeStrava, FakeTeams
+
+    # Sizes are totals, split evenly between the athletes
+    per_athlete = max(1, args.activities // args.athletes)
+    strava = FakeStrava(activity_count=per_athlete, latency=args.strava_latency,
+                        short_limit=args.strava_short_limit, athletes=args.athletes).start()
+    channels = [FakeTeams(latency=args.teams_latency, throttle_rate=args.throttle_rate,
+                          error_rate=args.error_rate, seed=seed).start() for seed in range(args.channels)]
+
+    os.chdir(tempfile.mkdtemp(prefix='strava-bench-'))
+    with open('tokens.json', 'w') as f:
+        json.dump({'access_token': 'fake', 'refresh_token': 'fake', 'expires_at': time.time() + 3600}, f)
+    if args.athletes > 1:
+        # Team mode: enrolled athletes with tokens the stand-in API tells apart
+        with open('athletes.json', 'w') as f:
+            json.dump({str(athlete_id): {'access_token': f"fake-access-{athlete_id}", 'refresh_token': 'fake',
+                                         'expires_at': time.time() + 3600, 'name': f"Athlete {athlete_id}"}
+                       for athlete_id in strava.athlete_ids}, f)
+    if args.channels > 1:
+        # Every activity goes to every channel
+        with open('routes.json', 'w') as f:
+            json.dump({'channels': {f"channel{i}": teams.webhook_url for i, teams in enumerate(channels)},
+                       'routes': [{'channel': f"channel{i}"} for i in range(len(channels))]}, f)
+    os.environ.update({
+        'STRAVA_API_URL': strava.url,
+        'TEAMS_WEBHOOK_URL': channels[0].webhook_url,
+        'TEAMS_ROUTES_FILE': os.path.join(os.getcwd(), 'routes.json'),
+        'STATE_DB': os.path.join(os.getcwd(), 'strava_bot.db'),
+        'ATHLETE_TOKEN_FILE': os.path.join(os.getcwd(), 'athletes.json'),
+        'LOOKBACK_HOURS': '24',
+        'TEAMS_RATE_PER_SECOND': str(args.teams_rate),
+        'TEAMS_RATE_BURST': str(max(1, int(args.teams_rate))),
+        'TEAMS_DIGEST': 'true' if args.digest else 'false',
+        'SHARD_WORKERS': str(args.shards),
+    })
+
+    import main
+
+    start = time.monotonic()
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        main.post_activities()
+    wall = time.monotonic() - start
+
+    posted = sum(teams.posted for teams in channels)
+    first_posts = [teams.first_post_at for teams in channels if teams.first_post_at]
+    result = {
+        'activities': per_athlete * args.athletes,
+        'athletes': args.athletes,
+        'shards': args.shards,
+        'wall_seconds': round(wall, 3),
+        'strava_calls': strava.total_calls,
+        'strava_calls_by_endpoint': strava.calls,
+        'channels': args.channels,
+        'teams_requests': sum(teams.requests for teams in channels),
+        'posts': posted,
+        'throttled': sum(teams.throttled for teams in channels),
+        'server_errors': sum(teams.errors for teams in channels),
+        'posts_per_second': round(posted / wall, 1) if wall else 0,
+        'first_post_seconds': round(min(first_posts) - start, 3) if first_posts else None,
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                             / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+    }
+    strava.stop()
+    for teams in channels:
+        teams.stop()
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sizes', nargs='*', type=int, default=[1, 100, 10000],
+                        help='numbers of activities to benchmark')
+    parser.add_argument('--strava-latency', type=float, default=0.02, help='seconds per Strava request')
+    parser.add_argument('--strava-short-limit', type=int, default=100000, help='15-minute request limit')
+    parser.add_argument('--teams-latency', type=float, default=0.01, help='seconds per webhook request')
+    parser.add_argument('--teams-rate', type=float, default=1000,
+                        help='client-side posts/second (Teams itself allows 4)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of posts answered 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of posts answered 503')
+    parser.add_argument('--digest', action='store_true', help='post digest cards')
+    parser.add_argument('--channels', type=int, default=1, help='Teams channels every activity is routed to')
+    parser.add_argument('--athletes', type=int, default=1, help='enrolled athletes sharing the activities')
+    parser.add_argument('--shards', type=int, default=1, help='worker processes (SHARD_WORKERS)')
+    parser.add_argument('--json', action='store_true', help='print raw JSON results')
+    parser.add_argument('--once', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.once is not None:
+        args.activities = args.once
+        return run_once(args)
+
+    passthrough = [
+        '--strava-latency', str(args.strava_latency),
+        '--strava-short-limit', str(args.strava_short_limit),
+        '--teams-latency', str(args.teams_latency),
+        '--teams-rate', str(args.teams_rate),
+        '--throttle-rate', str(args.throttle_rate),
+        '--error-rate', str(args.error_rate),
+        '--channels', str(args.channels),
+        '--athletes', str(args.athletes),
+        '--shards', str(args.shards),
+    ] + (['--digest'] if args.digest else [])
+    results = []
+    for size in args.sizes:
+        output = subprocess.run([sys.executable, __file__, '--once', str(size)] + passthrough,
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'activities':>10} {'wall s':>8} {'API calls':>9} {'posts':>6} {'posts/s':>8} "
+          f"{'1st post s':>10} {'429/5xx':>8} {'peak RSS MB':>11}")
+    for r in results:
+        first = f"{r['first_post_seconds']:.3f}" if r['first_post_seconds'] is not None else '-'
+        print(f"{r['activities']:>10} {r['wall_seconds']:>8.2f} {r['strava_calls']:>9} {r['posts']:>6} "
+              f"{r['posts_per_second']:>8.1f} {first:>10} {r['throttled'] + r['server_errors']:>8} "
+              f"{r['peak_rss_mb']:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark: times `python main.py --test` (the one-shot run external
+cron uses) from process start to its first Teams post and to exit, against a
+local stand-in Strava API and Teams webhook. Every run starts a fresh
+interpreter in a fresh working directory.
+
+    python3 benchmarks/bench_startup.py                 # 5 runs of 10 activities
+    python3 benchmarks/bench_startup.py --runs 10 --activities 1 --mode=--dry-run
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_services import FakeStrava, FakeTeams
+
+
+def run_once(strava, teams, mode):
+    """One cold run; returns (seconds to first post, seconds to exit)"""
+    workdir = tempfile.mkdtemp(prefix='strava-startup-')
+    with open(os.path.join(workdir, 'tokens.json'), 'w') as f:
+        json.dump({'access_token': 'fake', 'refresh_token': 'fake', 'expires_at': time.time() + 3600}, f)
+    env = dict(os.environ, STRAVA_API_URL=strava.url, TEAMS_WEBHOOK_URL=teams.webhook_url,
+               STATE_DB=os.path.join(workdir, 'strava_bot.db'),
+               ATHLETE_TOKEN_FILE=os.path.join(workdir, 'athletes.json'),
+               TEAMS_ROUTES_FILE=os.path.join(workdir, 'routes.json'),
+               TEAMS_RATE_PER_SECOND='1000', TEAMS_RATE_BURST='100')
+    teams.first_post_at = None
+    start = time.monotonic()
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'main.py'), mode], cwd=workdir, env=env,
+                   check=True, stdout=subprocess.DEVNULL)
+    done = time.monotonic() - start
+    first = teams.first_post_at - start if teams.first_post_at else None
+    return first, done
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='cold runs to time')
+    parser.add_argument('--activities', type=int, default=10, help='activities in the lookback window')
+    parser.add_argument('--mode', default='--test', help='main.py mode to run (--test or --dry-run)')
+    args = parser.parse_args()
+
+    strava = FakeStrava(activity_count=args.activities, latency=0.005).start()
+    teams = FakeTeams(latency=0.005).start()
+    firsts, totals = [], []
+    for _ in range(args.runs):
+        first, total = run_once(strava, teams, args.mode)
+        if first is not None:
+            firsts.append(first)
+        totals.append(total)
+    strava.stop()
+    teams.stop()
+
+    print(f"{'runs':>5} {'1st post s (median)':>20} {'exit s (median)':>16} {'exit s (min)':>13}")
+    first = f"{statistics.median(firsts):.3f}" if firsts else '-'
+    print(f"{args.runs:>5} {first:>20} {statistics.median(totals):>16.3f} {min(totals):>13.3f}")
+
+
+if __name__ == '__main__':
+    main()
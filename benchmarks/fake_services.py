@@ -0,0 +1,308 @@
+"""
+Local stand-ins for the Strava API and a Teams incoming webhook, for benchmarks.
+
+FakeStrava serves the endpoints the bot uses (OAuth token refresh, /athlete,
+/athlete/activities, /activities/{id} and /activities/{id}/photos) with a configurable number of
+activities, per-request latency and X-RateLimit headers, answering 429 once
+the 15-minute limit is used up. With several athletes, each one's requests are
+told apart by their access token (`fake-access-<athlete id>`) and each has
+their own activities. FakeTeams accepts posts and can inject 429 (with
+Retry-After) and 5xx replies.
+
+Point the bot at them with STRAVA_API_URL and TEAMS_WEBHOOK_URL.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ACTIVITY_TYPES = ['Run', 'Ride', 'Swim', 'Walk', 'Hike', 'WeightTraining']
+
+# Activity ids of athlete n start after (n - 1) * ID_STRIDE
+ID_STRIDE = 10000000
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Benchmarks open many concurrent connections
+    request_queue_size = 256
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, Nagle plus delayed
+    # ACKs stall every keep-alive response by ~40 ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+
+class _FakeService:
+    handler = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        handler = type('Handler', (self.handler,), {'service': self})
+        self.server = _Server(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _StravaHandler(_Handler):
+    def do_POST(self):
+        self._read_body()
+        if self.path.startswith('/oauth/token'):
+            self.service.count('token')
+            return self._json({
+                'access_token': 'fake-access-token',
+                'refresh_token': 'fake-refresh-token',
+                'expires_at': int(time.time()) + 6 * 3600,
+            })
+        self._reply(404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        service = self.service
+
+        if not service.take_request():
+            return self._reply(429, b'{"message":"Rate Limit Exceeded"}', service.rate_headers())
+        time.sleep(service.latency)
+
+        # stravalib sends the token as a query parameter
+        athlete_id = service.athlete_for(query.get('access_token') or self.headers.get('Authorization'))
+        if url.path == '/api/v3/athlete':
+            service.count('athlete')
+            return self._json(service.athlete(athlete_id))
+        if url.path == '/api/v3/athlete/activities':
+            service.count('activities')
+            return self._json(service.summaries(
+                athlete_id,
+                after=float(query.get('after') or 0),
+                before=float(query['before']) if query.get('before') else None,
+                page=int(query.get('page') or 1),
+                per_page=int(query.get('per_page') or 30),
+            ))
+        match = re.fullmatch(r'/api/v3/activities/(\d+)/photos', url.path)
+        if match:
+            service.count('photos')
+            return self._json(service.photos(int(match.group(1))))
+        match = re.fullmatch(r'/api/v3/activities/(\d+)', url.path)
+        if match:
+            service.count('activity')
+            activity = service.activity(int(match.group(1)))
+            if activity is None:
+                return self._reply(404, b'{"message":"Record Not Found"}')
+            return self._json(activity)
+        self._reply(404)
+
+    def _json(self, data):
+        headers = {'Content-Type': 'application/json'}
+        headers.update(self.service.rate_headers())
+        self._reply(200, json.dumps(data).encode('utf-8'), headers)
+
+
+class FakeStrava(_FakeService):
+    """Stand-in Strava API serving `activity_count` activities spread over `span_hours`,
+    for each of `athletes` athletes (ids athlete_id, athlete_id + 1, ...)"""
+
+    handler = _StravaHandler
+
+    def __init__(self, activity_count=100, latency=0.02, span_hours=23, short_limit=100000,
+                 long_limit=1000000, photo_every=5, athlete_id=1, athletes=1):
+        super().__init__()
+        self.latency = latency
+        self.short_limit = short_limit
+        self.long_limit = long_limit
+        self.photo_every = photo_every
+        self.athlete_id = athlete_id
+        self.athlete_ids = range(athlete_id, athlete_id + athletes)
+        self.usage = 0
+        self.calls = {}
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        first = now - timedelta(hours=span_hours)
+        step = timedelta(hours=span_hours) / max(activity_count, 1)
+        # Oldest first, like Strava when `after` is given
+        self.start_times = [first + step * i for i in range(activity_count)]
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def take_request(self):
+        """Count a request against the rate limits; False when the limit is used up"""
+        with self.lock:
+            if self.usage >= self.short_limit:
+                return False
+            self.usage += 1
+            return True
+
+    def rate_headers(self):
+        limit = f"{self.short_limit},{self.long_limit}"
+        usage = f"{self.usage},{self.usage}"
+        return {
+            'X-RateLimit-Limit': limit, 'X-RateLimit-Usage': usage,
+            'X-ReadRateLimit-Limit': limit, 'X-ReadRateLimit-Usage': usage,
+        }
+
+    def athlete_for(self, token):
+        """Athlete id an access token (or Authorization header) belongs to"""
+        token = (token or '').rsplit(' ', 1)[-1]
+        if token.startswith('fake-access-') and token[len('fake-access-'):].isdigit():
+            return int(token[len('fake-access-'):])
+        return self.athlete_id
+
+    def _split_id(self, activity_id):
+        """(athlete id, activity index) of an activity id, None if there is no such activity"""
+        athlete_id = self.athlete_id + (activity_id - 1) // ID_STRIDE
+        index = (activity_id - 1) % ID_STRIDE
+        if athlete_id not in self.athlete_ids or not 0 <= index < len(self.start_times):
+            return None
+        return athlete_id, index
+
+    def athlete(self, athlete_id=None):
+        athlete_id = athlete_id or self.athlete_id
+        return {'id': athlete_id, 'resource_state': 3, 'firstname': 'Pat',
+                'lastname': 'Athlete' if athlete_id == self.athlete_id else f"Athlete {athlete_id}"}
+
+    def _activity(self, index, detail, athlete_id=None):
+        athlete_id = athlete_id or self.athlete_id
+        activity_id = (athlete_id - self.athlete_id) * ID_STRIDE + index + 1
+        start = self.start_times[index]
+        activity_type = ACTIVITY_TYPES[index % len(ACTIVITY_TYPES)]
+        has_photo = self.photo_every and index % self.photo_every == 0
+        data = {
+            'id': activity_id,
+            'resource_state': 3 if detail else 2,
+            'athlete': {'id': athlete_id, 'resource_state': 1},
+            'name': f"{activity_type} #{index + 1}",
+            'type': activity_type,
+            'sport_type': activity_type,
+            'start_date': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'start_date_local': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'timezone': '(GMT+00:00) UTC',
+            'distance': 1000.0 + (index * 37) % 20000,
+            'moving_time': 600 + (index * 13) % 7200,
+            'elapsed_time': 700 + (index * 13) % 7200,
+            'total_elevation_gain': float(index % 300),
+            'average_heartrate': 120.0 + index % 50,
+            'max_heartrate': 160.0 + index % 30,
+            'total_photo_count': 1 if has_photo else 0,
+        }
+        if detail:
+            data['calories'] = 200.0 + index % 900
+            data['description'] = "Felt great" if index % 4 == 0 else None
+            data['photos'] = {
+                'count': 1 if has_photo else 0,
+                'primary': {
+                    'id': None,
+                    'source': 1,
+                    'unique_id': f"photo-{activity_id}",
+                    'urls': {'100': f"https://photos.example.com/{activity_id}-100.jpg",
+                             '600': f"https://photos.example.com/{activity_id}-600.jpg"},
+                } if has_photo else None,
+            }
+        return data
+
+    def photos(self, activity_id):
+        split = self._split_id(activity_id)
+        if split is None or not (self.photo_every and split[1] % self.photo_every == 0):
+            return []
+        return [{'unique_id': f"photo-{activity_id}", 'default_photo': True, 'source': 1,
+                 'urls': {'600': f"https://photos.example.com/{activity_id}-600.jpg"}}]
+
+    def summaries(self, athlete_id, after, before, page, per_page):
+        matching = [i for i, start in enumerate(self.start_times)
+                    if start.timestamp() > after and (before is None or start.timestamp() < before)]
+        if not after:
+            # Without `after` Strava returns the newest first
+            matching.reverse()
+        chunk = matching[(page - 1) * per_page:page * per_page]
+        return [self._activity(i, detail=False, athlete_id=athlete_id) for i in chunk]
+
+    def activity(self, activity_id):
+        split = self._split_id(activity_id)
+        if split is None:
+            return None
+        return self._activity(split[1], detail=True, athlete_id=split[0])
+
+
+class _TeamsHandler(_Handler):
+    def do_POST(self):
+        body = self._read_body()
+        status, headers = self.service.receive(body)
+        self._reply(status, b'1' if status == 200 else b'', headers)
+
+
+class FakeTeams(_FakeService):
+    """Stand-in Teams incoming webhook that can inject throttling and server errors"""
+
+    handler = _TeamsHandler
+
+    def __init__(self, latency=0.01, throttle_rate=0.0, error_rate=0.0, retry_after=1, seed=0):
+        super().__init__()
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.posted = 0
+        self.throttled = 0
+        self.errors = 0
+        self.bytes = 0
+        self.first_post_at = None
+
+    @property
+    def webhook_url(self):
+        return f"{self.url}/webhook"
+
+    def receive(self, body):
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            roll = self.random.random()
+            if roll < self.throttle_rate:
+                self.throttled += 1
+                return 429, {'Retry-After': str(self.retry_after)}
+            if roll < self.throttle_rate + self.error_rate:
+                self.errors += 1
+                return 503, {}
+            self.posted += 1
+            self.bytes += len(body)
+            if self.first_post_at is None:
+                self.first_post_at = time.monotonic()
+            return 200, {}
@@ -0,0 +1,255 @@
+import json
+import config
+from activity_record import METERS_TO_FEET, METERS_TO_MILES, METERS_TO_YARDS
+
+try:
+    import orjson
+except ImportError:  # Optional: falls back to the stdlib encoder
+    orjson = None
+
+
+def _stdlib_dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+# Serialize to compact UTF-8 JSON bytes
+dumps = orjson.dumps if orjson is not None else _stdlib_dumps
+
+
+# Placeholder marking where per-activity values go in a template
+SLOT = '\x00slot\x00'
+
+
+class Template:
+    """A card element serialized once, with SLOT placeholders filled in per activity"""
+
+    def __init__(self, element):
+        self.parts = dumps(element).split(dumps(SLOT))
+
+    def fill(self, *values):
+        """Fill the slots, in order, with already-encoded JSON bytes"""
+        if len(values) == 1:
+            return self.parts[0] + values[0] + self.parts[1]
+        out = [self.parts[0]]
+        for value, part in zip(values, self.parts[1:]):
+            out.append(value)
+            out.append(part)
+        return b''.join(out)
+
+
+def json_list(fragments):
+    """Join encoded elements into an encoded JSON array"""
+    return b'[' + b','.join(fragments) + b']'
+
+
+# Static skeleton of every message and its body elements
+MESSAGE = Template({
+    "type": "message",
+    "attachments": [
+        {
+            "contentType": "application/vnd.microsoft.card.adaptive",
+            "content": {
+                "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+                "type": "AdaptiveCard",
+                "version": "1.4",
+                "body": SLOT
+            }
+        }
+    ]
+})
+IMAGE = Template({"type": "Image", "url": SLOT, "size": "Stretch"})
+TITLE = Template({"type": "TextBlock", "text": SLOT, "size": "Large", "weight": "Bolder"})
+ATHLETE = Template({"type": "TextBlock", "text": SLOT, "size": "Small", "weight": "Lighter",
+                    "color": "Accent", "spacing": "None"})
+DATE = Template({"type": "TextBlock", "text": SLOT, "size": "Small", "color": "Default", "spacing": "None"})
+ACTIVITY_TYPE = Template({"type": "TextBlock", "text": SLOT, "size": "Small", "weight": "Lighter",
+                          "spacing": "None"})
+FACTS = Template({"type": "FactSet", "facts": SLOT, "spacing": "Medium"})
+DESCRIPTION = Template({"type": "TextBlock", "text": SLOT, "wrap": True, "spacing": "Medium"})
+STRAVA_LINK = Template({
+    "type": "ActionSet",
+    "actions": [
+        {
+            "type": "Action.OpenUrl",
+            "title": "View on Strava",
+            "url": SLOT
+        }
+    ]
+})
+HEADING = Template({"type": "TextBlock", "text": SLOT, "size": "Large", "weight": "Bolder", "wrap": True})
+SECTION_TITLE = Template({"type": "TextBlock", "text": SLOT, "size": "Medium", "weight": "Bolder", "wrap": True})
+# Digest section: a clickable header that toggles the activity's details
+SECTION = Template({
+    "type": "Container",
+    "separator": True,
+    "spacing": "Medium",
+    "items": [
+        {
+            "type": "Container",
+            "selectAction": {
+                "type": "Action.ToggleVisibility",
+                "targetElements": [SLOT]
+            },
+            "items": SLOT
+        },
+        {
+            "type": "Container",
+            "id": SLOT,
+            "isVisible": False,
+            "items": SLOT
+        }
+    ]
+})
+
+
+# Stats layouts by activity type; anything unregistered uses default_layout
+LAYOUTS = {}
+
+
+def layout(*activity_types):
+    """Register a function building the stats (FactSet facts) for these activity types"""
+    def register(func):
+        for activity_type in activity_types:
+            LAYOUTS[activity_type] = func
+        return func
+    return register
+
+
+def _facts(activity, distance=None, rate=None):
+    """Facts shared by every layout, around the layout's distance and pace/speed facts"""
+    facts = []
+    if distance:
+        facts.append(distance)
+    if activity.moving_time > 0:
+        facts.append({"title": "Time", "value": activity.moving_time_text})
+    if rate:
+        facts.append(rate)
+    if activity.feet > 0:
+        facts.append({"title": "Elevation", "value": f"{activity.feet:.0f} ft"})
+    if activity.average_heartrate:
+        facts.append({"title": "Avg HR", "value": f"{activity.average_heartrate:.0f} bpm"})
+    if activity.max_heartrate:
+        facts.append({"title": "Max HR", "value": f"{activity.max_heartrate:.0f} bpm"})
+    if activity.calories:
+        facts.append({"title": "Calories", "value": f"{activity.calories:.0f}"})
+    return facts
+
+
+def _pace(seconds):
+    return f"{int(seconds // 60)}:{int(seconds % 60):02d}"
+
+
+def _duration(seconds):
+    """Total time as '12h 5m' (or '45m' under an hour)"""
+    hours, minutes = divmod(int(seconds) // 60, 60)
+    return f"{hours}h {minutes}m" if hours else f"{minutes}m"
+
+
+def _activities(count):
+    return f"{count} activit{'y' if count == 1 else 'ies'}"
+
+
+@layout('Swim')
+def swim_layout(activity):
+    """Distance in yards and pace per 100 yd"""
+    if activity.yards <= 0:
+        return _facts(activity)
+    return _facts(activity,
+                  {"title": "Distance", "value": f"{activity.yards:.0f} yd"},
+                  {"title": "Pace", "value": f"{_pace(activity.pace_seconds)} /100yd"})
+
+
+@layout('Run', 'Walk', 'Hike')
+def pace_layout(activity):
+    """Distance in miles and pace per mile"""
+    if activity.miles <= 0:
+        return _facts(activity)
+    rate = None
+    if activity.moving_time > 0:
+        rate = {"title": "Pace", "value": f"{_pace(activity.pace_seconds)} /mi"}
+    return _facts(activity, {"title": "Distance", "value": f"{activity.miles:.2f} mi"}, rate)
+
+
+def default_layout(activity):
+    """Distance in miles and speed in mph"""
+    if activity.miles <= 0:
+        return _facts(activity)
+    rate = None
+    if activity.moving_time > 0:
+        rate = {"title": "Speed", "value": f"{activity.speed_mph:.1f} mph"}
+    return _facts(activity, {"title": "Distance", "value": f"{activity.miles:.2f} mi"}, rate)
+
+
+class CardRenderer:
+    """Renders ActivityRecords straight to Adaptive Card JSON bytes from precompiled templates"""
+
+    def body(self, activity, athlete_name=None):
+        """Encoded body elements for one activity, title first (after any photo)"""
+        date_str = activity.start_date_local.strftime('%A, %B %d, %Y')
+        if config.SHOW_WORKOUT_TIME:
+            date_str = f"{date_str} at {activity.start_date_local.strftime('%I:%M %p')}"
+
+        elements = []
+        if activity.photo_url:
+            elements.append(IMAGE.fill(dumps(activity.photo_url)))
+        elements.append(TITLE.fill(dumps(activity.name)))
+        if athlete_name:
+            elements.append(ATHLETE.fill(dumps(f"by {athlete_name}")))
+        elements.append(DATE.fill(dumps(date_str)))
+        elements.append(ACTIVITY_TYPE.fill(dumps(activity.type)))
+
+        facts = LAYOUTS.get(activity.type, default_layout)(activity)
+        if facts:
+            elements.append(FACTS.fill(dumps(facts)))
+        if activity.description:
+            elements.append(DESCRIPTION.fill(dumps(activity.description)))
+        elements.append(STRAVA_LINK.fill(dumps(f"https://www.strava.com/activities/{activity.id}")))
+        return elements
+
+    def message(self, elements):
+        """Wrap encoded body elements in the Teams message envelope"""
+        return MESSAGE.fill(json_list(elements))
+
+    def card(self, activity, athlete_name=None):
+        """A complete single-activity message"""
+        return self.message(self.body(activity, athlete_name=athlete_name))
+
+    def heading(self, text):
+        return HEADING.fill(dumps(text))
+
+    def leaderboard(self, heading, standings, type_totals, athlete_names=None):
+        """A team leaderboard message from TeamStats.leaderboard standings and
+        TeamStats.type_totals; athlete_names maps athlete keys to display names"""
+        facts = []
+        for rank, entry in enumerate(standings, start=1):
+            value = (f"{entry['distance'] * METERS_TO_MILES:.1f} mi · {_duration(entry['moving_time'])} · "
+                     f"{entry['elevation'] * METERS_TO_FEET:,.0f} ft · {_activities(entry['count'])}")
+            if entry['streak'] > 1:
+                value += f" · {entry['streak']}-day streak"
+            name = (athlete_names or {}).get(entry['athlete'], entry['athlete'])
+            facts.append({"title": f"{rank}. {name}", "value": value})
+
+        type_facts = []
+        for activity_type, totals in sorted(type_totals.items(), key=lambda item: -item[1]['count']):
+            if activity_type == 'Swim':
+                distance = f"{totals['distance'] * METERS_TO_YARDS:,.0f} yd"
+            else:
+                distance = f"{totals['distance'] * METERS_TO_MILES:,.1f} mi"
+            type_facts.append({"title": activity_type,
+                               "value": f"{distance} · {_duration(totals['moving_time'])} · "
+                                        f"{_activities(totals['count'])}"})
+
+        return self.message([self.heading(heading),
+                             SECTION_TITLE.fill(dumps("Leaderboard")), FACTS.fill(dumps(facts)),
+                             SECTION_TITLE.fill(dumps("Team totals by sport")), FACTS.fill(dumps(type_facts))])
+
+    def digest_section(self, activity, athlete_name=None):
+        """A collapsible digest section: the title (and athlete) toggles the rest of the body"""
+        elements = self.body(activity)
+        title_index = 1 if activity.photo_url else 0
+        header = [SECTION_TITLE.fill(dumps(activity.name))]
+        if athlete_name:
+            header.append(ATHLETE.fill(dumps(f"by {athlete_name}")))
+        details = elements[:title_index] + elements[title_index + 1:]
+        details_id = dumps(f"activity-{activity.id}")
+        return SECTION.fill(details_id, json_list(header), details_id, json_list(details))
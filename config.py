@@ -8,18 +8,103 @@ STRAVA_CLIENT_ID = os.getenv('STRAVA_CLIENT_ID')
 STRAVA_CLIENT_SECRET = os.getenv('STRAVA_CLIENT_SECRET')
 STRAVA_REFRESH_TOKEN = os.getenv('STRAVA_REFRESH_TOKEN')
 
+# Base URL for Strava API and OAuth requests (point at a proxy or a stand-in server)
+STRAVA_API_URL = os.getenv('STRAVA_API_URL', 'https://www.strava.com')
+
 # Teams Configuration
 TEAMS_WEBHOOK_URL = os.getenv('TEAMS_WEBHOOK_URL')
 
+# Routing rules sending activities to several Teams channels by type, athlete and
+# distance (see routing.py for the format); without this file everything goes to
+# TEAMS_WEBHOOK_URL
+TEAMS_ROUTES_FILE = os.getenv('TEAMS_ROUTES_FILE', 'routes.json')
+
+# Teams webhook posting (per channel): client-side throttle (Teams throttles incoming webhooks
+# at 4 requests per second), request timeout and retries for 429/5xx replies
+TEAMS_RATE_PER_SECOND = float(os.getenv('TEAMS_RATE_PER_SECOND', '4'))
+TEAMS_RATE_BURST = int(os.getenv('TEAMS_RATE_BURST', '4'))
+TEAMS_TIMEOUT_SECONDS = float(os.getenv('TEAMS_TIMEOUT_SECONDS', '30'))
+TEAMS_MAX_RETRIES = int(os.getenv('TEAMS_MAX_RETRIES', '5'))
+
+# Outbox of rendered messages waiting for Teams: failed messages are retried after
+# OUTBOX_RETRY_SECONDS (or on the next run) and dead-lettered after OUTBOX_MAX_ATTEMPTS;
+# a message being sent is leased for OUTBOX_LEASE_SECONDS, after which a crashed
+# sender's message is replayed
+OUTBOX_RETRY_SECONDS = float(os.getenv('OUTBOX_RETRY_SECONDS', '300'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_LEASE_SECONDS = float(os.getenv('OUTBOX_LEASE_SECONDS', '600'))
+
+# Digest mode: pack all of a run's activities into one collapsible card, split
+# into several messages only when it exceeds the Teams message size limit (~28 KB)
+TEAMS_DIGEST = os.getenv('TEAMS_DIGEST', 'false').lower() == 'true'
+TEAMS_MAX_PAYLOAD_BYTES = int(os.getenv('TEAMS_MAX_PAYLOAD_BYTES', '28000'))
+
+# Webhook (event-driven) mode: port for Strava push-subscription events, the token
+# Strava echoes back when validating the subscription, and how long to wait for
+# follow-up updates to an activity before posting it
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+STRAVA_WEBHOOK_VERIFY_TOKEN = os.getenv('STRAVA_WEBHOOK_VERIFY_TOKEN', 'STRAVA')
+WEBHOOK_COALESCE_SECONDS = float(os.getenv('WEBHOOK_COALESCE_SECONDS', '10'))
+
 # Scheduling Configuration
 TIMEZONE = os.getenv('TIMEZONE', 'America/New_York')
 # Cron format: minute hour day month day-of-week
 # Default: 9:00 AM on weekdays (Monday-Friday)
 SCHEDULE_CRON = os.getenv('SCHEDULE_CRON', '0 9 * * 1-5')
 
-# Lookback period in hours
+# Lookback period in hours for an athlete's first run; later runs continue from
+# the sync cursor (the newest activity already handled)
 LOOKBACK_HOURS = int(os.getenv('LOOKBACK_HOURS', '24'))
 
+# Hours before the sync cursor to re-check, for activities uploaded late
+SYNC_OVERLAP_HOURS = float(os.getenv('SYNC_OVERLAP_HOURS', '12'))
+
+# Strava rate limits, used until the first response reports the real ones (defaults
+# are Strava's read limits), and the longest a request may wait for a window to reset
+# before its work is left for the next run
+STRAVA_RATE_LIMIT_15MIN = int(os.getenv('STRAVA_RATE_LIMIT_15MIN', '100'))
+STRAVA_RATE_LIMIT_DAILY = int(os.getenv('STRAVA_RATE_LIMIT_DAILY', '1000'))
+STRAVA_RATE_MAX_WAIT_SECONDS = float(os.getenv('STRAVA_RATE_MAX_WAIT_SECONDS', '900'))
+
+# Data beyond the activity list shown on cards, comma-separated: photos, description,
+# calories. Photos cost one small lookup per activity with photos (remembered after
+# that); description and calories need a detail request for every activity. Set it to
+# 'photos' to save that quota at the cost of descriptions and calories on cards.
+CARD_DETAIL_FIELDS = {field.strip() for field in
+                      os.getenv('CARD_DETAIL_FIELDS', 'photos,description,calories').lower().split(',')
+                      if field.strip()}
+
+# Team leaderboards, built from the activities runs and backfills store: when to post
+# last week's and last month's standings (cron format; empty disables), the channels
+# they go to (comma-separated names from the routes file; default: every channel) and
+# how many athletes they list
+LEADERBOARD_WEEKLY_CRON = os.getenv('LEADERBOARD_WEEKLY_CRON', '')
+LEADERBOARD_MONTHLY_CRON = os.getenv('LEADERBOARD_MONTHLY_CRON', '')
+LEADERBOARD_CHANNELS = {channel.strip() for channel in os.getenv('LEADERBOARD_CHANNELS', '').split(',')
+                        if channel.strip()}
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', '10'))
+
+# Days of history the team stats keep in memory (also the longest streak they can see)
+TEAM_STATS_DAYS = int(os.getenv('TEAM_STATS_DAYS', '400'))
+
+# Local photo proxy: with PHOTO_BASE_URL (the public URL Teams reaches the bot's /photos
+# endpoint at) set, card photos are downloaded once into PHOTO_CACHE_DIR, kept to
+# PHOTO_CACHE_MAX_MB (least recently used evicted first) and served from PHOTO_PORT;
+# without it cards link Strava's copies
+PHOTO_BASE_URL = os.getenv('PHOTO_BASE_URL', '').rstrip('/')
+PHOTO_CACHE_DIR = os.getenv('PHOTO_CACHE_DIR', 'photos')
+PHOTO_CACHE_MAX_MB = float(os.getenv('PHOTO_CACHE_MAX_MB', '200'))
+PHOTO_PORT = int(os.getenv('PHOTO_PORT', '8090'))
+PHOTO_HOST = os.getenv('PHOTO_HOST', '0.0.0.0')
+
+# Number of activity details fetched from Strava in parallel
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', '8'))
+
+# Streaming pipeline: cards rendered and posted to Teams in parallel (per channel), and how many activities
+# may wait between stages before the stage feeding them blocks
+POST_WORKERS = int(os.getenv('POST_WORKERS', '2'))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '32'))
+
 # Display Configuration
 # Show workout time in Teams posts (default: true)
 SHOW_WORKOUT_TIME = os.getenv('SHOW_WORKOUT_TIME', 'true').lower() != 'false'
@@ -27,5 +112,42 @@ SHOW_WORKOUT_TIME = os.getenv('SHOW_WORKOUT_TIME', 'true').lower() != 'false'
 # Token storage
 TOKEN_FILE = 'tokens.json'
 
+# Refresh access tokens this long before they expire, so no request races the expiry
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv('TOKEN_REFRESH_MARGIN_SECONDS', '600'))
+
+# How long the scheduler keeps an athlete's looked-up profile (display name)
+ATHLETE_PROFILE_TTL_HOURS = float(os.getenv('ATHLETE_PROFILE_TTL_HOURS', '24'))
+
+# Team mode: tokens for every athlete enrolled with `auth_helper.py --team`, keyed by
+# athlete id. When this file has athletes, every run posts all of them.
+ATHLETE_TOKEN_FILE = os.getenv('ATHLETE_TOKEN_FILE', 'athletes.json')
+
+# Number of athletes processed in parallel in team mode
+ATHLETE_WORKERS = int(os.getenv('ATHLETE_WORKERS', '16'))
+
+# Sharded team runs: split enrolled athletes across this many worker processes (by
+# consistent hashing), each fetching and rendering for its own athletes with its own
+# slice of the Strava rate limits; 1 runs everything in the main process
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '1'))
+
+# Local state database (activity cache and other run-to-run state)
+STATE_DB = os.getenv('STATE_DB', 'strava_bot.db')
+
+# Activity detail cache: entries expire after this many hours (0 disables the cache)
+# and only the newest ACTIVITY_CACHE_MAX_ENTRIES are kept
+ACTIVITY_CACHE_TTL_HOURS = float(os.getenv('ACTIVITY_CACHE_TTL_HOURS', '24'))
+ACTIVITY_CACHE_MAX_ENTRIES = int(os.getenv('ACTIVITY_CACHE_MAX_ENTRIES', '5000'))
+
+# Where `main.py --profile` writes its trace (and cProfile stats)
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+# Logging: 'text' prints plain messages, 'json' writes one JSON object per line
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+
+# Prometheus metrics endpoint (/metrics) served by the scheduler process; 0 disables it.
+# Set METRICS_HOST to 0.0.0.0 to allow scrapes from outside the container.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
 # SSL Configuration - set to 'false' to disable SSL verification (needed for corporate proxies)
 SSL_VERIFY = os.getenv('SSL_VERIFY', 'true').lower() != 'false'
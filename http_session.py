@@ -0,0 +1,19 @@
+import requests
+import urllib3
+import config
+
+if not config.SSL_VERIFY:
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+class Session(requests.Session):
+    """requests.Session for every outgoing call (Strava, Teams, photo downloads).
+
+    With SSL_VERIFY=false (corporate proxies that re-sign TLS), certificates are not
+    checked, whatever REQUESTS_CA_BUNDLE says.
+    """
+
+    def request(self, *args, **kwargs):
+        if not config.SSL_VERIFY:
+            kwargs['verify'] = False
+        return super().request(*args, **kwargs)
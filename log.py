@@ -0,0 +1,46 @@
+"""
+Run logging. With LOG_FORMAT=json every message is one JSON object per line
+(time, level, message and any extra fields) for log collectors; the default
+text format prints messages as they read.
+"""
+
+import json
+import threading
+from datetime import datetime, timezone
+import config
+
+_lock = threading.Lock()
+
+
+def _emit(level, message, fields):
+    if config.LOG_FORMAT == 'json':
+        record = {'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+                  'level': level, 'message': message.strip()}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False, default=str)
+    else:
+        line = message
+    # One write per line, so lines from worker threads don't interleave
+    with _lock:
+        print(line, flush=True)
+
+
+def info(message, **fields):
+    _emit('info', message, fields)
+
+
+def warning(message, **fields):
+    _emit('warning', message, fields)
+
+
+def error(message, **fields):
+    _emit('error', message, fields)
+
+
+def banner(*lines, level='info', **fields):
+    """A framed block of lines in text mode; a single record (the first line) in JSON mode"""
+    if config.LOG_FORMAT == 'json':
+        _emit(level, lines[0], dict(fields, details=list(lines[1:])) if lines[1:] else fields)
+        return
+    rule = '=' * 60
+    _emit(level, '\n'.join([f"\n{rule}", *lines, f"{rule}\n"]), fields)
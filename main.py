@@ -1,101 +1,366 @@
+import os
 import sys
-from datetime import datetime
-from apscheduler.schedulers.blocking import BlockingScheduler
-from apscheduler.triggers.cron import CronTrigger
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import pytz
 import config
-from strava_client import StravaClient
+import log
+import metrics
+import photos
+import profiling
+from activity_store import ActivityStore
+from card_renderer import CardRenderer
+from pipeline import ActivityPipeline
+from rate_governor import BudgetExhausted
+from strava_client import get_client
+from sync_cursor import SyncCursor
 from teams_poster import TeamsPoster
+from token_store import TokenStore
 
 
-def post_activities(dry_run=False):
-    """Main function to fetch and post activities"""
-    print(f"\n{'='*60}")
-    print(f"Running at {datetime.now(pytz.timezone(config.TIMEZONE))}")
+def history_recorder(strava):
+    """on_page callback keeping every fetched summary for the team stats"""
+    store = ActivityStore()
+    return lambda page: store.put_many(strava.sync_key, page)
+
+
+def start_sync(strava, cursor):
+    """Look up an athlete's name and where their sync starts: (athlete name, UTC datetime
+    to fetch activities after)"""
+    athlete_name = strava.get_athlete_name()
+    log.info(f"Athlete: {athlete_name}", athlete=athlete_name)
+    
+    # Only ask Strava for activities after the athlete's sync cursor. After downtime
+    # this catches up from where the last run stopped.
+    after = cursor.start_after(strava.sync_key)
+    log.info(f"Fetching activities since {after:%Y-%m-%d %H:%M} UTC...", athlete=athlete_name,
+             after=after.isoformat())
+    return athlete_name, after
+
+
+def fetch_athlete_activities(strava, cursor):
+    """Fetch new activities for one athlete, returning (athlete name, activities)"""
+    athlete_name, after = start_sync(strava, cursor)
+    activities = strava.get_recent_activities(after=after, on_page=history_recorder(strava))
+    
+    metrics.ACTIVITIES_FOUND.inc(len(activities))
+    log.info(f"Found {len(activities)} activity(ies) for {athlete_name}", athlete=athlete_name,
+             found=len(activities))
+    return athlete_name, activities
+
+
+def mark_synced(cursor, sync_key, activities, started):
+    """Advance a sync cursor once a run that started at `started` (epoch seconds)
+    has posted all its activities.
+    
+    The mark moves to the run's start even if it found nothing, so a quiet athlete
+    doesn't fall back to the LOOKBACK_HOURS window after a long outage;
+    SYNC_OVERLAP_HOURS still covers activities uploaded late.
+    """
+    cursor.save(sync_key, max([started] + [a.start_date.timestamp() for a in activities]))
+
+
+def post_athlete_activities(strava, teams, cursor):
+    """Fetch and post new activities for one athlete"""
+    started = time.time()
+    if config.TEAMS_DIGEST:
+        # A digest needs every activity before it can be built
+        athlete_name, activities = fetch_athlete_activities(strava, cursor)
+        if teams.post_summary(activities, athlete_name=athlete_name) and not teams.dry_run:
+            mark_synced(cursor, strava.sync_key, activities, started)
+        return
+    
+    athlete_name, after = start_sync(strava, cursor)
+    
+    # Progress is checkpointed every page, so an interrupted catch-up resumes from there
+    def checkpoint(synced_until):
+        if not teams.dry_run:
+            cursor.save(strava.sync_key, synced_until)
+    
+    # Stream activities straight into Teams posts as each one is fetched
+    pipeline = ActivityPipeline(strava, teams, on_checkpoint=checkpoint)
+    try:
+        found = pipeline.run(strava.iter_summaries_after(after, on_page=history_recorder(strava)),
+                             athlete_name=athlete_name)
+    finally:
+        # Keep whatever progress was made, even if paging failed part way
+        if pipeline.high_water_mark:
+            checkpoint(pipeline.high_water_mark)
+    
+    metrics.ACTIVITIES_FOUND.inc(found)
+    if not pipeline.failed and not pipeline.deferred and not pipeline.budget_exhausted:
+        # Everything up to the start of the run is handled, found or not
+        checkpoint(started)
+    if pipeline.budget_exhausted:
+        log.warning(f"Strava rate limit budget spent - {athlete_name}'s remaining activities "
+                    f"are left for the next run", athlete=athlete_name, deferred=pipeline.deferred)
+    if found:
+        log.info(f"Found {found} activity(ies) for {athlete_name}, "
+                 f"queued {pipeline.posted} to post, failed {pipeline.failed}", athlete=athlete_name,
+                 found=found, queued=pipeline.posted, failed=pipeline.failed)
+    elif not pipeline.budget_exhausted:
+        log.info("No new activities - skipping post", athlete=athlete_name)
+
+
+def run_athletes(athlete_ids, token_store, teams, cursor):
+    """Fetch new activities for athletes in parallel, posting them unless building a digest.
+    
+    Returns (fetched, failed): for digests, (sync key, athlete name, activities) for
+    each athlete fetched; and the ids of athletes that failed.
+    """
+    def run_athlete(athlete_id):
+        try:
+            strava = get_client(athlete_id, token_store=token_store)
+            if config.TEAMS_DIGEST:
+                # Collect everyone's activities for a single team digest
+                return (strava.sync_key,) + fetch_athlete_activities(strava, cursor), None
+            post_athlete_activities(strava, teams, cursor)
+            return None, None
+        except BudgetExhausted as e:
+            # Not a failure: the athlete's cursor stays put and the next run catches up
+            log.warning(f"Deferred athlete {athlete_id} to the next run: {str(e)}", athlete_id=athlete_id)
+            return None, None
+        except Exception as e:
+            # One athlete's revoked token shouldn't stop the rest of the team
+            log.error(f"✗ Error for athlete {athlete_id}: {str(e)}", athlete_id=athlete_id)
+            return None, athlete_id
+    
+    workers = max(1, min(config.ATHLETE_WORKERS, len(athlete_ids)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run_athlete, athlete_ids))
+    return ([result for result, _ in results if result],
+            [athlete_id for _, athlete_id in results if athlete_id is not None])
+
+
+def post_team_activities(token_store, teams, cursor):
+    """Fetch and post new activities for every enrolled athlete in parallel"""
+    athlete_ids = token_store.athlete_ids()
+    started = time.time()
+    if config.SHARD_WORKERS > 1:
+        log.info(f"Team mode: {len(athlete_ids)} athlete(s) across {config.SHARD_WORKERS} shards",
+                 athletes=len(athlete_ids), shards=config.SHARD_WORKERS)
+        import shards
+        fetched, failed = shards.get_pool().run(athlete_ids, teams)
+    else:
+        log.info(f"Team mode: {len(athlete_ids)} athlete(s)", athletes=len(athlete_ids))
+        fetched, failed = run_athletes(athlete_ids, token_store, teams, cursor)
+    
+    if config.TEAMS_DIGEST:
+        activities = []
+        athlete_names = {}
+        for _, athlete_name, athlete_activities in fetched:
+            activities.extend(athlete_activities)
+            athlete_names.update((a.id, athlete_name) for a in athlete_activities)
+        if not activities:
+            log.info("No new activities - skipping post")
+        if (not activities or teams.post_digest(activities, athlete_names=athlete_names)) and not teams.dry_run:
+            for sync_key, _, athlete_activities in fetched:
+                mark_synced(cursor, sync_key, athlete_activities, started)
+    
+    if failed:
+        raise RuntimeError(f"Failed for {len(failed)} athlete(s): {', '.join(failed)}")
+
+
+def post_activities(dry_run=False, sender=None):
+    """Main function to fetch and post activities (queueing cards for a long-lived
+    OutboxSender if given, instead of sending them before returning)"""
+    started = f"Running at {datetime.now(pytz.timezone(config.TIMEZONE))}"
     if dry_run:
-        print("MODE: DRY RUN (no posting to Teams)")
-    print(f"{'='*60}\n")
+        log.banner(started, "MODE: DRY RUN (no posting to Teams)", dry_run=True)
+    else:
+        log.banner(started)
     
     try:
         # Initialize clients
-        strava = StravaClient()
-        teams = TeamsPoster(dry_run=dry_run)
-        
-        # Get athlete info
-        athlete = strava.get_athlete()
-        athlete_name = f"{athlete.firstname} {athlete.lastname}".strip()
-        print(f"Athlete: {athlete_name}")
-        
-        # Get recent activities
-        print(f"Fetching activities from the last {config.LOOKBACK_HOURS} hours...")
-        activities = strava.get_recent_activities(hours=config.LOOKBACK_HOURS)
-        
-        print(f"Found {len(activities)} activity(ies)")
+        teams = TeamsPoster(dry_run=dry_run, sender=sender)
+        token_store = TokenStore()
+        cursor = SyncCursor()
         
-        # Post to Teams
-        teams.post_summary(activities, athlete_name=athlete_name)
+        try:
+            if token_store.athlete_ids():
+                post_team_activities(token_store, teams, cursor)
+            else:
+                try:
+                    post_athlete_activities(get_client(), teams, cursor)
+                except BudgetExhausted as e:
+                    log.warning(f"Deferred to the next run: {str(e)}")
+        finally:
+            # Send everything queued, even if fetching failed part way (or leave it
+            # to the scheduler's sender)
+            teams.close()
         
-        print(f"\n{'='*60}")
-        print("✓ Completed successfully")
-        print(f"{'='*60}\n")
+        log.banner("✓ Completed successfully")
         
     except Exception as e:
-        print(f"\n{'='*60}")
-        print(f"✗ Error: {str(e)}")
-        print(f"{'='*60}\n")
+        log.banner(f"✗ Error: {str(e)}", level='error')
         raise
 
 
-def main():
-    """Main entry point"""
-    # Check if running in test mode
-    if len(sys.argv) > 1 and sys.argv[1] == '--test':
-        print("Running in TEST mode - posting immediately")
-        post_activities(dry_run=False)
-        return
-    
-    # Check if running in dry-run mode
-    if len(sys.argv) > 1 and sys.argv[1] == '--dry-run':
-        print("Running in DRY RUN mode - showing logs only, no posting")
-        post_activities(dry_run=True)
+def athlete_display_names(athletes, token_store):
+    """Display names for team stats athlete keys (enrolled athlete ids, or 'self')"""
+    names = {}
+    for athlete in athletes:
+        try:
+            if athlete == 'self':
+                names[athlete] = get_client().get_athlete_name()
+            else:
+                names[athlete] = ((token_store.get(athlete) or {}).get('name') or
+                                  get_client(athlete, token_store=token_store).get_athlete_name())
+        except Exception as e:
+            # Leave them listed by id rather than dropping the leaderboard
+            log.warning(f"Couldn't look up athlete {athlete}: {str(e)}", athlete_id=athlete)
+    return names
+
+
+def post_leaderboard(period='week', dry_run=False, sender=None):
+    """Post the team leaderboard for the last full week or month"""
+    # Deferred with NumPy: one-shot runs (--test, --dry-run) never need it
+    import team_stats
+    since, until = team_stats.last_period(period)
+    stats = team_stats.get_stats()
+    standings = stats.leaderboard(since, until, limit=config.LEADERBOARD_SIZE)
+    if not standings:
+        log.info(f"No activities from {since} to {until - timedelta(days=1)} - skipping leaderboard",
+                 period=period)
         return
     
-    # Validate configuration
-    if not config.STRAVA_CLIENT_ID or not config.STRAVA_CLIENT_SECRET:
-        print("ERROR: Strava API credentials not configured!")
-        print("Please set STRAVA_CLIENT_ID and STRAVA_CLIENT_SECRET in .env file")
-        sys.exit(1)
+    title = f"week of {since:%B} {since.day}" if period == 'week' else f"{since:%B %Y}"
+    card = CardRenderer().leaderboard(
+        f"Team leaderboard: {title}", standings, stats.type_totals(since, until),
+        athlete_names=athlete_display_names([entry['athlete'] for entry in standings], TokenStore())
+    )
+    teams = TeamsPoster(dry_run=dry_run, sender=sender)
+    try:
+        teams.post_leaderboard(card, title)
+    finally:
+        teams.close()
+    log.info(f"✓ Leaderboard for {title}: {len(standings)} athlete(s)", period=period,
+             athletes=len(standings))
+
+
+def run_scheduler():
+    """Post on the configured schedules until interrupted"""
+    # Deferred: one-shot runs (--test, --dry-run, external cron) never start a scheduler
+    from apscheduler.events import EVENT_JOB_MISSED
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    from apscheduler.triggers.cron import CronTrigger
     
-    if not config.TEAMS_WEBHOOK_URL:
-        print("ERROR: Teams webhook URL not configured!")
-        print("Please set TEAMS_WEBHOOK_URL in .env file")
-        sys.exit(1)
+    # One sender for every run: it keeps retrying failed cards between cron firings
+    # (and sends whatever an earlier process left queued straight away)
+    sender = TeamsPoster().sender
     
-    # Set up scheduler
     scheduler = BlockingScheduler(timezone=pytz.timezone(config.TIMEZONE))
     
     # Schedule using cron expression
     trigger = CronTrigger.from_crontab(config.SCHEDULE_CRON, timezone=config.TIMEZONE)
     
     scheduler.add_job(
-        post_activities,
+        metrics.instrument_job('post_strava_activities', post_activities),
         trigger=trigger,
+        kwargs={'sender': sender},
         id='post_strava_activities',
         name='Post Strava Activities to Teams',
-        misfire_grace_time=3600  # Allow 1 hour grace period
+        misfire_grace_time=3600,  # Allow 1 hour grace period
+        coalesce=True,  # Run missed firings once, not once each
+        max_instances=1  # Never let two runs post at the same time
     )
     
-    print(f"{'='*60}")
-    print("Strava Teams Bot Started")
-    print(f"{'='*60}")
-    print(f"Timezone: {config.TIMEZONE}")
-    print(f"Schedule (cron): {config.SCHEDULE_CRON}")
-    print(f"{'='*60}\n")
+    # Team leaderboards, each on its own schedule
+    for period, cron in (('week', config.LEADERBOARD_WEEKLY_CRON), ('month', config.LEADERBOARD_MONTHLY_CRON)):
+        if cron:
+            job_id = f"post_{period}ly_leaderboard"
+            scheduler.add_job(
+                metrics.instrument_job(job_id, post_leaderboard),
+                trigger=CronTrigger.from_crontab(cron, timezone=config.TIMEZONE),
+                args=[period],
+                kwargs={'sender': sender},
+                id=job_id,
+                name=f"Post {period}ly team leaderboard",
+                misfire_grace_time=3600,
+                coalesce=True,
+                max_instances=1
+            )
+    
+    # Count runs the scheduler had to drop for firing past the grace period
+    scheduler.add_listener(lambda event: metrics.JOBS_MISSED.inc(job=event.job_id), EVENT_JOB_MISSED)
+    
+    lines = ["Strava Teams Bot Started", f"Timezone: {config.TIMEZONE}",
+             f"Schedule (cron): {config.SCHEDULE_CRON}"]
+    if config.LEADERBOARD_WEEKLY_CRON:
+        lines.append(f"Weekly leaderboard (cron): {config.LEADERBOARD_WEEKLY_CRON}")
+    if config.LEADERBOARD_MONTHLY_CRON:
+        lines.append(f"Monthly leaderboard (cron): {config.LEADERBOARD_MONTHLY_CRON}")
+    if metrics.serve():
+        lines.append(f"Metrics: http://{config.METRICS_HOST}:{config.METRICS_PORT}/metrics")
+    if photos.serve():
+        lines.append(f"Photos: port {config.PHOTO_PORT}, linked as {config.PHOTO_BASE_URL}/...")
+    if config.SHARD_WORKERS > 1:
+        import shards
+        shards.get_pool().start()
+        lines.append(f"Shards: {config.SHARD_WORKERS} worker processes")
+    log.banner(*lines)
     
     try:
         scheduler.start()
     except (KeyboardInterrupt, SystemExit):
-        print("\nShutting down...")
+        log.info("\nShutting down...")
+
+
+def main():
+    """Main entry point"""
+    # Check if running in test mode
+    if len(sys.argv) > 1 and sys.argv[1] == '--test':
+        log.info("Running in TEST mode - posting immediately")
+        post_activities(dry_run=False)
+        return
+    
+    # Check if running in dry-run mode
+    if len(sys.argv) > 1 and sys.argv[1] == '--dry-run':
+        log.info("Running in DRY RUN mode - showing logs only, no posting")
+        post_activities(dry_run=True)
+        return
+    
+    # Check if profiling a single run
+    if len(sys.argv) > 1 and sys.argv[1] == '--profile':
+        profiling.start(cprofile='--cprofile' in sys.argv[2:])
+        try:
+            with profiling.span('post_activities'):
+                post_activities(dry_run='--dry-run' in sys.argv[2:])
+        finally:
+            profiling.stop()
+        return
+    
+    # Check if posting a leaderboard now
+    if len(sys.argv) > 1 and sys.argv[1] == '--leaderboard':
+        period = sys.argv[2] if len(sys.argv) > 2 and not sys.argv[2].startswith('--') else 'week'
+        post_leaderboard(period, dry_run='--dry-run' in sys.argv[2:])
+        return
+    
+    # Check if running a historical backfill
+    if len(sys.argv) > 1 and sys.argv[1] == '--backfill':
+        import backfill
+        sys.exit(backfill.main(sys.argv[2:]))
+    
+    # Check if running in webhook (event-driven) mode
+    if len(sys.argv) > 1 and sys.argv[1] == '--webhook':
+        import webhook_receiver
+        webhook_receiver.run(dry_run='--dry-run' in sys.argv[2:])
+        return
+    
+    # Validate configuration
+    if not config.STRAVA_CLIENT_ID or not config.STRAVA_CLIENT_SECRET:
+        log.error("ERROR: Strava API credentials not configured!\n"
+                  "Please set STRAVA_CLIENT_ID and STRAVA_CLIENT_SECRET in .env file")
+        sys.exit(1)
+    
+    if not config.TEAMS_WEBHOOK_URL and not os.path.exists(config.TEAMS_ROUTES_FILE):
+        log.error("ERROR: Teams webhook URL not configured!\n"
+                  "Please set TEAMS_WEBHOOK_URL in .env file, or route activities to channels "
+                  f"in {config.TEAMS_ROUTES_FILE}")
+        sys.exit(1)
+    
+    run_scheduler()
 
 
 if __name__ == '__main__':
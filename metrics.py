@@ -0,0 +1,270 @@
+"""
+In-process metrics, exported in the Prometheus text format at /metrics.
+
+Metrics are module-level objects updated from anywhere in the bot. The scheduler
+serves them on METRICS_PORT; webhook mode adds a /metrics route to its own app.
+"""
+
+import bisect
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import config
+
+
+# Request/post latencies are well under a minute; job runs can take much longer
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = []
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self):
+        """Exposition lines for every label set, one value each"""
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up (requests made, posts failed, ...)"""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    """A value that can go up and down (rate-limit headroom, last run time, ...)"""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, for latencies and durations"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes (also when it raises)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def collect():
+    """Every metric's samples by name, for another process to merge. Counters and
+    histograms are reset, so each collection holds only what happened since the last."""
+    samples = {}
+    for metric in _metrics:
+        with metric._lock:
+            samples[metric.name] = dict(metric._values)
+            if not isinstance(metric, Gauge):
+                metric._values.clear()
+    return samples
+
+
+def merge(samples):
+    """Add samples collected in another process (a shard worker); gauges take its value"""
+    by_name = {metric.name: metric for metric in _metrics}
+    for name, values in samples.items():
+        metric = by_name.get(name)
+        if metric is None:
+            continue
+        with metric._lock:
+            for key, value in values.items():
+                if isinstance(metric, Gauge):
+                    metric._values[key] = value
+                elif isinstance(metric, Histogram):
+                    counts, total = metric._values.get(key) or ([0] * (len(metric.buckets) + 1), 0.0)
+                    metric._values[key] = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+                else:
+                    metric._values[key] = metric._values.get(key, 0) + value
+
+
+# Strava API
+STRAVA_REQUESTS = Counter('strava_requests_total', "Strava API requests by endpoint and status",
+                          ['endpoint', 'status'])
+STRAVA_REQUEST_SECONDS = Histogram('strava_request_seconds', "Strava API response time", ['endpoint'])
+STRAVA_RATE_LIMIT = Gauge('strava_rate_limit', "Strava rate limit per window, from the last response",
+                          ['window'])
+STRAVA_RATE_USAGE = Gauge('strava_rate_limit_usage', "Strava requests used per window, from the last "
+                          "response", ['window'])
+STRAVA_RATE_WAITS = Counter('strava_rate_limit_waits_total', "Requests held back for a rate-limit "
+                            "window to reset, by priority", ['priority'])
+STRAVA_RATE_DEFERRED = Counter('strava_rate_limit_deferred_total', "Requests left for a later run "
+                               "because the budget is spent, by priority", ['priority'])
+STRAVA_CACHE = Counter('strava_activity_cache_total', "Activity detail lookups by cache result",
+                       ['result'])
+PHOTO_CACHE = Counter('photo_cache_total', "Local photo copies by result (hit, miss, error)", ['result'])
+PHOTO_CACHE_BYTES = Gauge('photo_cache_bytes', "Size of the local photo cache")
+
+# Teams
+TEAMS_REQUESTS = Counter('teams_requests_total', "Teams webhook requests (including retries) by channel "
+                         "and status", ['channel', 'status'])
+TEAMS_REQUEST_SECONDS = Histogram('teams_request_seconds', "Teams webhook response time", ['channel'])
+TEAMS_POSTS = Counter('teams_posts_total', "Teams messages by channel, kind and result",
+                      ['channel', 'kind', 'result'])
+OUTBOX_MESSAGES = Gauge('outbox_messages', "Messages in the outbox at the end of the last run, by status",
+                        ['status'])
+OUTBOX_DEAD_LETTERS = Counter('outbox_dead_letters_total', "Messages dead-lettered after failing to post")
+
+# Runs
+ACTIVITIES_FOUND = Counter('activities_found_total', "New activities found on Strava")
+ACTIVITY_SOURCES = Counter('activity_cards_total', "Activities planned for rendering, by whether "
+                           "the card needs a detail fetch, a photo lookup or just the summary", ['source'])
+ACTIVITY_FAILURES = Counter('activity_failures_total', "Activities that failed, by stage", ['stage'])
+JOB_RUNS = Counter('job_runs_total', "Scheduled job runs by result", ['job', 'result'])
+JOB_SECONDS = Histogram('job_duration_seconds', "Scheduled job run time", ['job'], buckets=JOB_BUCKETS)
+JOB_LAST_SUCCESS = Gauge('job_last_success_timestamp_seconds', "When the job last succeeded",
+                         ['job'])
+JOBS_MISSED = Counter('job_missed_total', "Scheduled runs skipped because they fired too late", ['job'])
+WEBHOOK_EVENTS = Counter('webhook_events_total', "Strava push events received", ['object_type', 'aspect_type'])
+
+
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def endpoint_name(url):
+    """Low-cardinality endpoint label for a Strava URL, e.g. /api/v3/activities/{id}"""
+    path = url.split('://', 1)[-1].split('?', 1)[0]
+    path = path[path.find('/'):] if '/' in path else '/'
+    return _ID_SEGMENT.sub('/{id}', path)
+
+
+def record_strava_response(response, *args, **kwargs):
+    """requests response hook counting and timing every Strava API call"""
+    endpoint = endpoint_name(response.request.url)
+    STRAVA_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    STRAVA_REQUEST_SECONDS.observe(response.elapsed.total_seconds(), endpoint=endpoint)
+
+
+def record_rates(short_usage, long_usage, short_limit, long_limit):
+    """Update the rate-limit gauges"""
+    STRAVA_RATE_LIMIT.set(short_limit, window='15m')
+    STRAVA_RATE_LIMIT.set(long_limit, window='daily')
+    STRAVA_RATE_USAGE.set(short_usage, window='15m')
+    STRAVA_RATE_USAGE.set(long_usage, window='daily')
+
+
+def instrument_job(job_id, func):
+    """Wrap a scheduler job so every run is timed and counted"""
+    def run(*args, **kwargs):
+        with JOB_SECONDS.time(job=job_id):
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                JOB_RUNS.inc(job=job_id, result='error')
+                raise
+        JOB_RUNS.inc(job=job_id, result='success')
+        JOB_LAST_SUCCESS.set(time.time(), job=job_id)
+        return result
+    return run
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(host=None, port=None):
+    """Serve /metrics from a background thread; returns the server (None if disabled)"""
+    port = config.METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host or config.METRICS_HOST, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
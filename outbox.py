@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Durable queue of rendered Teams messages waiting to be sent.
+
+Cards are written to the outbox as soon as they are rendered and a sender drains
+it in the background, so fetching and rendering never wait on a slow or throttled
+webhook, and a card survives a crash or a Teams outage until it is delivered.
+Messages that keep failing are dead-lettered; replay them once the cause is fixed:
+
+    python3 outbox.py --list      # show dead-lettered messages
+    python3 outbox.py --replay    # queue them again
+"""
+
+import json
+import sys
+import threading
+import time
+from contextlib import closing
+import config
+import log
+import metrics
+import storage
+from post_ledger import webhook_key
+from routing import DEFAULT_CHANNEL
+
+PENDING = 'pending'
+DEAD = 'dead'
+
+# Client errors that retrying can't fix (bad or oversized payload, unknown webhook)
+PERMANENT_STATUS_CODES = {400, 401, 403, 404, 410, 413}
+
+
+class Outbox:
+    """Persistent queue of encoded messages, each for one webhook and one or more activities"""
+
+    def __init__(self, path=None):
+        self.path = path
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    webhook TEXT NOT NULL,
+                    activity_ids TEXT NOT NULL,
+                    label TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox_activities (
+                    entry_id INTEGER NOT NULL,
+                    webhook TEXT NOT NULL,
+                    activity_id INTEGER NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_activities_id "
+                         "ON outbox_activities (webhook, activity_id)")
+
+    def enqueue(self, webhook_urls, payload, activity_ids, label=''):
+        """Queue an encoded message for each of webhook_urls, in one transaction
+        (committed before returning); returns their entry ids.
+        
+        label describes the message in logs, e.g. "activity: Morning Run".
+        """
+        activity_ids = list(activity_ids)
+        now = time.time()
+        entry_ids = []
+        with closing(storage.connect(self.path)) as conn, conn:
+            for webhook_url in webhook_urls:
+                key = webhook_key(webhook_url)
+                entry_id = conn.execute(
+                    "INSERT INTO outbox (webhook, activity_ids, label, payload, status, next_attempt_at, "
+                    "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, json.dumps(activity_ids), label, payload, PENDING, now, now)
+                ).lastrowid
+                conn.executemany(
+                    "INSERT INTO outbox_activities (entry_id, webhook, activity_id) VALUES (?, ?, ?)",
+                    [(entry_id, key, activity_id) for activity_id in activity_ids]
+                )
+                entry_ids.append(entry_id)
+        return entry_ids
+
+    def queued_ids(self, activity_ids, webhook_url):
+        """Return the subset of activity_ids already waiting (or dead-lettered) for webhook_url"""
+        with closing(storage.connect(self.path)) as conn:
+            rows = storage.select_in(
+                conn, "SELECT activity_id FROM outbox_activities WHERE webhook = ? AND activity_id IN ({ids})",
+                [webhook_key(webhook_url)], activity_ids)
+        return {row[0] for row in rows}
+
+    def claim(self, webhook_keys, lease_seconds=None):
+        """Take the oldest due message for one of the given webhooks.
+
+        The message stays in the outbox, leased for lease_seconds: if the sender dies
+        before completing or failing it, it becomes due again and is replayed.
+        Returns (entry id, webhook key, activity ids, label, payload, attempts) or None.
+        """
+        if not webhook_keys:
+            return None
+        lease_seconds = config.OUTBOX_LEASE_SECONDS if lease_seconds is None else lease_seconds
+        now = time.time()
+        placeholders = ','.join('?' * len(webhook_keys))
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                f"SELECT id, webhook, activity_ids, label, payload, attempts FROM outbox "
+                f"WHERE status = ? AND next_attempt_at <= ? AND webhook IN ({placeholders}) "
+                f"ORDER BY id LIMIT 1",
+                [PENDING, now] + list(webhook_keys)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE outbox SET next_attempt_at = ? WHERE id = ?", (now + lease_seconds, row[0]))
+        entry_id, key, activity_ids, label, payload, attempts = row
+        return entry_id, key, json.loads(activity_ids), label, bytes(payload), attempts
+
+    def complete(self, entry_id):
+        """Remove a delivered message"""
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+            conn.execute("DELETE FROM outbox_activities WHERE entry_id = ?", (entry_id,))
+
+    def fail(self, entry_id, error, retry_in=None, dead=False):
+        """Record a failed attempt: retry after retry_in seconds, or dead-letter the message"""
+        retry_in = config.OUTBOX_RETRY_SECONDS if retry_in is None else retry_in
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?, "
+                "status = CASE WHEN ? OR attempts + 1 >= ? THEN ? ELSE status END WHERE id = ?",
+                (error, time.time() + retry_in, dead, config.OUTBOX_MAX_ATTEMPTS, DEAD, entry_id)
+            )
+            return conn.execute("SELECT status FROM outbox WHERE id = ?", (entry_id,)).fetchone()[0] == DEAD
+
+    def counts(self):
+        """Number of messages by status"""
+        with closing(storage.connect(self.path)) as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+    def due_count(self, webhook_keys):
+        """Messages for the given webhooks that could be sent right now"""
+        if not webhook_keys:
+            return 0
+        placeholders = ','.join('?' * len(webhook_keys))
+        with closing(storage.connect(self.path)) as conn:
+            return conn.execute(
+                f"SELECT COUNT(*) FROM outbox WHERE status = ? AND next_attempt_at <= ? "
+                f"AND webhook IN ({placeholders})",
+                [PENDING, time.time()] + list(webhook_keys)
+            ).fetchone()[0]
+
+    def dead_letters(self):
+        """Dead-lettered messages as (entry id, label, attempts, last error, created at)"""
+        with closing(storage.connect(self.path)) as conn:
+            return conn.execute(
+                "SELECT id, label, attempts, last_error, created_at FROM outbox "
+                "WHERE status = ? ORDER BY id", (DEAD,)
+            ).fetchall()
+
+    def replay(self):
+        """Queue every dead-lettered message again; returns how many"""
+        with closing(storage.connect(self.path)) as conn, conn:
+            return conn.execute(
+                "UPDATE outbox SET status = ?, attempts = 0, next_attempt_at = ? WHERE status = ?",
+                (PENDING, time.time(), DEAD)
+            ).rowcount
+
+
+def _to(channel):
+    # Name the channel in text logs only when routing to named channels
+    return '' if channel == DEFAULT_CHANNEL else f" to {channel}"
+
+
+class OutboxSender:
+    """Background workers draining an Outbox, `workers` per webhook.
+
+    Each webhook has its own workers and WebhookTransport, so a slow or throttled
+    channel never holds up the others and adding channels doesn't add run time.
+    """
+
+    def __init__(self, outbox, ledger, workers=None):
+        self.outbox = outbox
+        self.ledger = ledger
+        self.workers = workers or config.POST_WORKERS
+        self.sent = 0
+        self.failed = 0
+        self.dead = 0
+        # (URL, transport, channel name) by webhook key: the outbox only stores hashes
+        self._webhooks = {}
+        self._active = 0
+        self._running = False
+        self._stopping = False
+        self._threads = []
+        self._condition = threading.Condition()
+
+    def add_webhook(self, webhook_url, transport, channel=DEFAULT_CHANNEL):
+        """Send messages queued for webhook_url (starting its workers if already running)"""
+        key = webhook_key(webhook_url)
+        with self._condition:
+            if key in self._webhooks:
+                return
+            self._webhooks[key] = (webhook_url, transport, channel)
+            if self._running:
+                self._start_workers(key)
+
+    def _start_workers(self, key):
+        threads = [threading.Thread(target=self._run, args=(key,), daemon=True) for _ in range(self.workers)]
+        self._threads.extend(threads)
+        for thread in threads:
+            thread.start()
+
+    def start(self):
+        """Start the workers (if not running yet); they pick up anything already queued"""
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._stopping = False
+            for key in self._webhooks:
+                self._start_workers(key)
+
+    def notify(self):
+        """Wake the workers after a message was queued"""
+        with self._condition:
+            self._condition.notify_all()
+
+    def _run(self, key):
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                self._active += 1
+            try:
+                entry = self.outbox.claim([key])
+                if entry is not None:
+                    self._send(*entry)
+            except Exception as e:
+                log.error(f"✗ Outbox error: {str(e)}")
+                entry = None
+            finally:
+                with self._condition:
+                    self._active -= 1
+                    self._condition.notify_all()
+            if entry is None:
+                with self._condition:
+                    if not self._stopping:
+                        # Nothing due: sleep until notified, or poll for retries coming due
+                        self._condition.wait(5)
+
+    def _send(self, entry_id, key, activity_ids, label, payload, attempts):
+        # Labels start with the kind: "activity: ...", "digest of ...", "leaderboard: ..."
+        kind = label.split(':')[0].split()[0]
+        url, transport, channel = self._webhooks[key]
+        status = None
+        try:
+            response = transport.post(url, payload)
+            status = response.status_code
+            if status in [200, 202]:
+                # Ledger first: a crash in between re-sends (at least once), never drops
+                for activity_id in activity_ids:
+                    self.ledger.record(activity_id, url)
+                self.outbox.complete(entry_id)
+                metrics.TEAMS_POSTS.inc(channel=channel, kind=kind, result='ok')
+                with self._condition:
+                    self.sent += 1
+                log.info(f"✓ Posted {label}{_to(channel)}", channel=channel, activity_ids=activity_ids)
+                return
+            error = f"Status: {status} - {response.text[:500]}"
+        except Exception as e:
+            error = str(e)
+
+        metrics.TEAMS_POSTS.inc(channel=channel, kind=kind, result='failed')
+        dead = self.outbox.fail(entry_id, error, dead=status in PERMANENT_STATUS_CODES)
+        with self._condition:
+            self.failed += 1
+            self.dead += dead
+        if dead:
+            metrics.OUTBOX_DEAD_LETTERS.inc()
+            log.error(f"✗ Dead-lettered {label}{_to(channel)} after {attempts + 1} attempt(s) - {error}",
+                      channel=channel, activity_ids=activity_ids, entry_id=entry_id)
+        else:
+            log.error(f"✗ Failed to post {label}{_to(channel)}, will retry in "
+                      f"{config.OUTBOX_RETRY_SECONDS:.0f}s - {error}",
+                      channel=channel, activity_ids=activity_ids, entry_id=entry_id)
+
+    def drain(self, timeout=None):
+        """Wait until nothing queued is due and no send is in flight; False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                # Workers only claim while counted as active, so checking both under the
+                # lock can't miss a message being picked up
+                if self._active == 0 and not self.outbox.due_count(list(self._webhooks)):
+                    return True
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+                self._condition.wait(0.05)
+
+    def stop(self):
+        """Stop the workers once their current sends finish"""
+        with self._condition:
+            self._stopping = True
+            self._running = False
+            threads, self._threads = self._threads, []
+            self._condition.notify_all()
+        for thread in threads:
+            thread.join()
+
+
+def main():
+    outbox = Outbox()
+    if len(sys.argv) > 1 and sys.argv[1] == '--replay':
+        print(f"✓ Queued {outbox.replay()} dead-lettered message(s) again; "
+              f"they are sent on the next run")
+    elif len(sys.argv) > 1 and sys.argv[1] == '--list':
+        letters = outbox.dead_letters()
+        for entry_id, label, attempts, error, created_at in letters:
+            created = time.strftime('%Y-%m-%d %H:%M', time.localtime(created_at))
+            print(f"#{entry_id} {label} (queued {created}, {attempts} attempt(s)): {error}")
+        print(f"{len(letters)} dead-lettered message(s); pending: {outbox.counts().get(PENDING, 0)}")
+    else:
+        print(__doc__)
+
+
+if __name__ == '__main__':
+    main()
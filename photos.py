@@ -0,0 +1,201 @@
+"""
+Activity photos for card headers.
+
+PhotoUrlCache remembers each activity's primary photo URL, so it is looked up
+from Strava once per activity. PhotoCache is an optional local image proxy: with
+PHOTO_BASE_URL set, each photo is downloaded once into PHOTO_CACHE_DIR (stored
+by content hash, so the same image is kept once) and cards point at the bot's
+/photos endpoint instead of hot-linking Strava's CDN. The cache is bounded to
+PHOTO_CACHE_MAX_MB, evicting the least recently used photos first.
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import config
+import log
+import metrics
+import storage
+from http_session import Session
+
+# Served file names: content hash plus extension
+_NAME = re.compile(r'[0-9a-f]{64}\.(jpg|png|gif|webp)')
+_EXTENSIONS = {'image/png': '.png', 'image/gif': '.gif', 'image/webp': '.webp'}
+_CONTENT_TYPES = {'.jpg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif', '.webp': 'image/webp'}
+
+# Larger downloads are not cached (Strava's 600 px photos are well under this)
+MAX_PHOTO_BYTES = 5 * 1024 * 1024
+
+
+class PhotoUrlCache:
+    """Primary photo URL by activity id ('' for activities whose photos had no URL)"""
+
+    def __init__(self, path=None):
+        self.path = path
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS photo_urls (
+                    activity_id INTEGER PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    resolved_at REAL NOT NULL
+                )
+            """)
+
+    def get_many(self, activity_ids):
+        """Known URLs for the given activities, by id"""
+        with closing(storage.connect(self.path)) as conn:
+            return dict(storage.select_in(
+                conn, "SELECT activity_id, url FROM photo_urls WHERE activity_id IN ({ids})", [], activity_ids))
+
+    def put_many(self, urls):
+        """Remember URLs given as {activity id: url}"""
+        now = time.time()
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO photo_urls (activity_id, url, resolved_at) VALUES (?, ?, ?)",
+                [(activity_id, url or '', now) for activity_id, url in urls.items()]
+            )
+
+
+class PhotoCache:
+    """Size-bounded, content-addressed local copies of activity photos"""
+
+    def __init__(self, path=None, directory=None, base_url=None, max_mb=None):
+        self.path = path
+        self.directory = directory or config.PHOTO_CACHE_DIR
+        self.base_url = (config.PHOTO_BASE_URL if base_url is None else base_url).rstrip('/')
+        self.max_bytes = (config.PHOTO_CACHE_MAX_MB if max_mb is None else max_mb) * 1024 * 1024
+        self.session = Session()
+        self._lock = threading.Lock()
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS photo_files (
+                    url TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS photo_files_name ON photo_files (name)")
+
+    @property
+    def enabled(self):
+        return bool(self.base_url)
+
+    def localize(self, activity):
+        """Point an activity's photo_url at the local copy, downloading it the first time.
+
+        Without PHOTO_BASE_URL, or if the download fails, the Strava URL is kept.
+        """
+        if not self.enabled or not activity.photo_url or activity.photo_url.startswith(self.base_url):
+            return
+        name = self._cached(activity.photo_url) or self._download(activity.photo_url)
+        if name:
+            activity.photo_url = f"{self.base_url}/{name}"
+
+    def _cached(self, url):
+        with closing(storage.connect(self.path)) as conn, conn:
+            row = conn.execute("SELECT name FROM photo_files WHERE url = ?", (url,)).fetchone()
+            if row is None or not os.path.exists(os.path.join(self.directory, row[0])):
+                return None
+            conn.execute("UPDATE photo_files SET last_used = ? WHERE url = ?", (time.time(), url))
+        metrics.PHOTO_CACHE.inc(result='hit')
+        return row[0]
+
+    def _download(self, url):
+        try:
+            response = self.session.get(url, timeout=config.TEAMS_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            content = response.content
+            if len(content) > MAX_PHOTO_BYTES:
+                raise ValueError(f"{len(content)} bytes is over the {MAX_PHOTO_BYTES} byte limit")
+        except Exception as e:
+            metrics.PHOTO_CACHE.inc(result='error')
+            log.warning(f"Couldn't cache photo, linking Strava's copy instead: {str(e)}")
+            return None
+        metrics.PHOTO_CACHE.inc(result='miss')
+
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        name = hashlib.sha256(content).hexdigest() + _EXTENSIONS.get(content_type, '.jpg')
+        file_path = os.path.join(self.directory, name)
+        # Another URL (or an earlier run) may already have stored the same image
+        if not os.path.exists(file_path):
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, file_path)
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO photo_files (url, name, size, last_used) VALUES (?, ?, ?, ?)",
+                         (url, name, len(content), time.time()))
+        self.evict()
+        return name
+
+    def evict(self):
+        """Delete the least recently used photos until the cache fits in max_bytes"""
+        with self._lock, closing(storage.connect(self.path)) as conn, conn:
+            # One file per name, however many URLs share it
+            files = conn.execute(
+                "SELECT name, MAX(size), MAX(last_used) FROM photo_files GROUP BY name ORDER BY MAX(last_used)"
+            ).fetchall()
+            total = sum(size for _, size, _ in files)
+            for name, size, _ in files:
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM photo_files WHERE name = ?", (name,))
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+            metrics.PHOTO_CACHE_BYTES.set(total)
+
+    def read(self, name):
+        """(bytes, content type) of a cached photo, None if it isn't cached"""
+        if not _NAME.fullmatch(name or ''):
+            return None
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                return f.read(), _CONTENT_TYPES[os.path.splitext(name)[1]]
+        except FileNotFoundError:
+            return None
+
+
+def _handler(cache):
+    class PhotoHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            photo = cache.read(path[len('/photos/'):]) if path.startswith('/photos/') else None
+            if photo is None:
+                self.send_error(404)
+                return
+            body, content_type = photo
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            # Names are content hashes, so a URL's content never changes
+            self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return PhotoHandler
+
+
+def serve(cache=None, host=None, port=None):
+    """Serve cached photos at /photos/<name> from a background thread; returns the
+    server (None if PHOTO_BASE_URL or PHOTO_PORT isn't set)"""
+    cache = cache or PhotoCache()
+    port = config.PHOTO_PORT if port is None else port
+    if not cache.enabled or not port:
+        return None
+    server = ThreadingHTTPServer((host or config.PHOTO_HOST, port), _handler(cache))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,159 @@
+import queue
+import threading
+from collections import deque
+import config
+import log
+import metrics
+from rate_governor import PHOTO, BudgetExhausted, detail_priority
+from strava_client import cards_need_details, needs_photo
+
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class ActivityPipeline:
+    """Streams activities from Strava into Teams posts.
+
+    Summaries are paged lazily into a bounded queue, fetch workers add details or
+    photo URLs where the card needs them, and post workers send each card as soon
+    as its activity arrives. Summaries whose card needs neither skip the fetch
+    stage. Bounded queues give backpressure, so memory stays flat however many
+    activities are in the window. Posts go out in the order fetches complete.
+    
+    high_water_mark is the start time (epoch seconds) of the last summary, in feed
+    order, before which every activity was handled successfully; it is what the
+    sync cursor can safely advance to.
+    
+    When the Strava rate-limit budget runs out for longer than the governor may wait,
+    paging stops and the remaining activities are counted as deferred: they hold the
+    mark back like failures, so the next run picks them up.
+    """
+
+    def __init__(self, strava, teams, fetch_workers=None, post_workers=None, queue_size=None,
+                 on_checkpoint=None):
+        self.strava = strava
+        self.teams = teams
+        self.fetch_workers = fetch_workers or config.FETCH_WORKERS
+        self.post_workers = post_workers or config.POST_WORKERS
+        self.queue_size = queue_size or config.PIPELINE_QUEUE_SIZE
+        # Called with high_water_mark after every page of summaries
+        self.on_checkpoint = on_checkpoint
+        self.posted = 0
+        self.failed = 0
+        self.deferred = 0
+        self.budget_exhausted = False
+        self.high_water_mark = None
+        # Whether cards need a detail request (for every activity, when they do)
+        self.fetch_details = cards_need_details()
+        self._pending = deque()
+        self._done = {}
+        self._count_lock = threading.Lock()
+
+    def _feed(self, summary):
+        with self._count_lock:
+            self._pending.append((summary.id, summary.start_date.timestamp()))
+
+    def _count(self, activity_id, ok, posted=True, deferred=False):
+        with self._count_lock:
+            if deferred:
+                self.deferred += 1
+            elif not ok:
+                self.failed += 1
+            elif posted:
+                self.posted += 1
+            self._done[activity_id] = ok
+            # Advance over the finished prefix; a failure holds the mark back for good
+            while self._pending and self._done.get(self._pending[0][0]):
+                done_id, start = self._pending.popleft()
+                del self._done[done_id]
+                self.high_water_mark = start
+
+    def _fetch(self, fetch_q, post_q):
+        while True:
+            item = fetch_q.get()
+            if item is _DONE:
+                return
+            summary, priority = item
+            activity_id = summary.id
+            if self.budget_exhausted:
+                # Don't queue more requests behind a spent budget
+                self._count(activity_id, False, deferred=True)
+                continue
+            try:
+                activity = summary
+                if self.fetch_details:
+                    activity = self.strava.get_activity_details(activity_id, priority=priority)
+                post_q.put(self.strava.resolve_photo(activity))
+            except BudgetExhausted:
+                # Photo-bearing activities yield first; the rest carry on until their own
+                # (larger) share of the budget is spent too
+                if priority != PHOTO:
+                    self.budget_exhausted = True
+                self._count(activity_id, False, deferred=True)
+            except Exception as e:
+                log.error(f"✗ Error fetching activity {activity_id}: {str(e)}", activity_id=activity_id)
+                metrics.ACTIVITY_FAILURES.inc(stage='fetch')
+                self._count(activity_id, False)
+
+    def _post(self, post_q, athlete_name):
+        while True:
+            activity = post_q.get()
+            if activity is _DONE:
+                return
+            try:
+                ok = self.teams.post_activity(activity, athlete_name=athlete_name)
+            except Exception as e:
+                # A dead post worker would leave the fetchers blocked on a full queue
+                log.error(f"✗ Error posting activity {activity.id}: {str(e)}", activity_id=activity.id)
+                metrics.ACTIVITY_FAILURES.inc(stage='post')
+                ok = False
+            self._count(activity.id, ok)
+
+    def run(self, summaries, athlete_name=None):
+        """Fetch and post every summary activity not already posted; returns the number found"""
+        fetch_q = queue.Queue(maxsize=self.queue_size)
+        post_q = queue.Queue(maxsize=self.queue_size)
+        fetchers = [threading.Thread(target=self._fetch, args=(fetch_q, post_q), daemon=True)
+                    for _ in range(self.fetch_workers)]
+        posters = [threading.Thread(target=self._post, args=(post_q, athlete_name), daemon=True)
+                   for _ in range(self.post_workers)]
+        for thread in fetchers + posters:
+            thread.start()
+        
+        found = 0
+        try:
+            # Feed summaries one page at a time; put() blocks when the fetchers fall behind
+            for summary in summaries:
+                if self.budget_exhausted:
+                    break
+                found += 1
+                self._feed(summary)
+                if not self.teams.unposted_channels(summary):
+                    self._count(summary.id, True, posted=False)
+                elif self.fetch_details or needs_photo(summary):
+                    metrics.ACTIVITY_SOURCES.inc(source='detail' if self.fetch_details else 'photo')
+                    fetch_q.put((summary, detail_priority(summary)))
+                else:
+                    # The summary has everything the card shows: skip the fetch stage
+                    metrics.ACTIVITY_SOURCES.inc(source='summary')
+                    post_q.put(summary)
+                if self.on_checkpoint and found % 200 == 0 and self.high_water_mark:
+                    self.on_checkpoint(self.high_water_mark)
+        except BudgetExhausted:
+            # Paging itself ran out of budget
+            self.budget_exhausted = True
+        finally:
+            # Always shut the stages down in order, even if paging failed part way
+            for _ in fetchers:
+                fetch_q.put(_DONE)
+            for thread in fetchers:
+                thread.join()
+            for _ in posters:
+                post_q.put(_DONE)
+            for thread in posters:
+                thread.join()
+        
+        if self.strava.cache is not None:
+            self.strava.cache.evict()
+        return found
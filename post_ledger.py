@@ -0,0 +1,41 @@
+import hashlib
+import time
+from contextlib import closing
+import storage
+
+
+def webhook_key(webhook_url):
+    # Webhook URLs embed a secret, so only a hash of the URL is stored
+    return hashlib.sha256((webhook_url or '').encode('utf-8')).hexdigest()
+
+
+class PostLedger:
+    """Durable record of which activities were already posted to which webhook"""
+
+    def __init__(self, path=None):
+        self.path = path
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS posted_activities (
+                    activity_id INTEGER NOT NULL,
+                    webhook TEXT NOT NULL,
+                    posted_at REAL NOT NULL,
+                    PRIMARY KEY (activity_id, webhook)
+                )
+            """)
+
+    def posted_ids(self, activity_ids, webhook_url):
+        """Return the subset of activity_ids already posted to webhook_url"""
+        with closing(storage.connect(self.path)) as conn:
+            rows = storage.select_in(
+                conn, "SELECT activity_id FROM posted_activities WHERE webhook = ? AND activity_id IN ({ids})",
+                [webhook_key(webhook_url)], activity_ids)
+        return {row[0] for row in rows}
+
+    def record(self, activity_id, webhook_url):
+        """Mark an activity as posted (committed before returning)"""
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO posted_activities (activity_id, webhook, posted_at) VALUES (?, ?, ?)",
+                (activity_id, webhook_key(webhook_url), time.time())
+            )
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Per-stage timing for a single run (`main.py --profile`).
+
+While recording, every stage of the run (token refresh, activity list pages,
+activity details and photo lookups, card rendering, webhook posts) is timed as
+a span and written as a Chrome trace: open it at chrome://tracing or
+https://ui.perfetto.dev to see each thread's timeline. With --cprofile every
+thread is also run under cProfile, dumped next to the trace for pstats or
+snakeviz. Compare two runs' stage totals (e.g. across releases) with:
+
+    python3 profiling.py profiles/old.trace.json profiles/new.trace.json
+
+When nothing is recording, span() returns a shared no-op object, so the
+instrumented code pays one function call per stage.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from datetime import datetime
+import config
+import log
+
+# Spans recorded so far, (name, thread id, start, end, args); None when not recording
+_spans = None
+_thread_names = {}
+_started = 0.0
+
+# Per-thread cProfile profilers (--cprofile)
+_profilers = []
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    def __init__(self, name, args, spans):
+        self.name = name
+        self.args = args
+        # Kept, so a span still open when recording stops ends harmlessly
+        self.spans = spans
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **args):
+        """Add args learned inside the block (e.g. a response status)"""
+        self.args.update(args)
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        thread = threading.current_thread()
+        _thread_names[thread.ident] = thread.name
+        self.spans.append((self.name, thread.ident, self.start, end, self.args))
+        return False
+
+
+def span(name, **args):
+    """Time the block as a stage of the run (when recording); args are shown with it"""
+    if _spans is None:
+        return _NO_SPAN
+    return _Span(name, args, _spans)
+
+
+def _profile_thread(frame, event, arg):
+    # Installed for new threads: the first event starts a profiler of the thread's own
+    profiler = cProfile.Profile()
+    _profilers.append(profiler)
+    profiler.enable()
+
+
+def start(cprofile=False):
+    """Start recording spans (and profiling every thread with cProfile)"""
+    global _spans, _started
+    _thread_names.clear()
+    _profilers.clear()
+    _started = time.perf_counter()
+    _spans = []
+    if cprofile:
+        threading.setprofile(_profile_thread)
+        profiler = cProfile.Profile()
+        _profilers.append(profiler)
+        profiler.enable()
+
+
+def stage_totals(spans):
+    """{stage: {count, total, max}} (seconds) from (name, start, end) triples"""
+    stages = {}
+    for name, start, end in spans:
+        stage = stages.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+        stage['count'] += 1
+        stage['total'] += end - start
+        stage['max'] = max(stage['max'], end - start)
+    return stages
+
+
+def stop(directory=None):
+    """Stop recording and write the trace (and cProfile stats); returns the files written"""
+    global _spans
+    spans, _spans = _spans, None
+    threading.setprofile(None)
+    if _profilers:
+        _profilers[0].disable()
+
+    directory = directory or config.PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f"profile-{datetime.now():%Y%m%d-%H%M%S}")
+    pid = os.getpid()
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+              for tid, name in _thread_names.items()]
+    events.extend({'name': name, 'cat': 'stage', 'ph': 'X', 'pid': pid, 'tid': tid,
+                   'ts': round((start - _started) * 1e6, 1), 'dur': round((end - start) * 1e6, 1),
+                   'args': args} for name, tid, start, end, args in spans)
+    stages = stage_totals((name, start, end) for name, _, start, end, _ in spans)
+    with open(f"{base}.trace.json", 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                   'otherData': {'stages': stages}}, f, default=str)
+    files = [f"{base}.trace.json"]
+
+    if _profilers:
+        # Every thread's profile in one file
+        stats = pstats.Stats(_profilers[0])
+        for profiler in _profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(f"{base}.prof")
+        files.append(f"{base}.prof")
+        _profilers.clear()
+
+    lines = [f"{'stage':<24} {'count':>6} {'total s':>9} {'mean ms':>9} {'max ms':>9}"]
+    for name, stage in sorted(stages.items(), key=lambda item: -item[1]['total']):
+        lines.append(f"{name:<24} {stage['count']:>6} {stage['total']:>9.3f} "
+                     f"{stage['total'] / stage['count'] * 1000:>9.1f} {stage['max'] * 1000:>9.1f}")
+    log.banner("Run profile", *lines, *files, stages=stages, files=files)
+    return files
+
+
+def _load_stages(path):
+    with open(path, 'r') as f:
+        return json.load(f).get('otherData', {}).get('stages', {})
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__)
+        return
+    old, new = (_load_stages(path) for path in sys.argv[1:])
+    print(f"{'stage':<24} {'old s':>9} {'new s':>9} {'change':>8} {'old n':>6} {'new n':>6}")
+    for name in sorted(set(old) | set(new), key=lambda name: -new.get(name, old.get(name))['total']):
+        before = old.get(name, {'count': 0, 'total': 0.0})
+        after = new.get(name, {'count': 0, 'total': 0.0})
+        change = f"{(after['total'] / before['total'] - 1) * 100:+.0f}%" if before['total'] else '-'
+        print(f"{name:<24} {before['total']:>9.3f} {after['total']:>9.3f} {change:>8} "
+              f"{before['count']:>6} {after['count']:>6}")
+
+
+if __name__ == '__main__':
+    main()
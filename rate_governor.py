@@ -0,0 +1,174 @@
+import threading
+import time
+from contextlib import contextmanager
+import config
+import log
+import metrics
+
+
+# Request priorities, most important first. Each may use only its share of a
+# rate-limit window, so as a window fills up the least important calls wait for
+# the next one and the rest keep going.
+CRITICAL = 'critical'  # Token refresh and athlete profile: nothing works without them
+SUMMARY = 'summary'    # Activity list pages (up to 200 activities per call)
+DETAIL = 'detail'      # Activity details
+PHOTO = 'photo'        # Photo lookups, and details of activities with photos (the largest cards)
+BACKFILL = 'backfill'  # History pages for `main.py --backfill`: never crowds out posting
+
+PRIORITY_SHARE = {CRITICAL: 1.0, SUMMARY: 0.95, DETAIL: 0.9, PHOTO: 0.85, BACKFILL: 0.75}
+
+SHORT_WINDOW_SECONDS = 15 * 60
+LONG_WINDOW_SECONDS = 24 * 60 * 60
+
+
+class BudgetExhausted(Exception):
+    """The rate-limit budget won't allow a request for longer than the governor may wait"""
+
+
+def priority_for_url(url):
+    """Default priority of a Strava request, by endpoint"""
+    if '/oauth/' in url or url.split('?', 1)[0].endswith('/athlete'):
+        return CRITICAL
+    if '/athlete/activities' in url:
+        return SUMMARY
+    return DETAIL
+
+
+def rates_from_headers(headers, method='GET'):
+    """(short usage, long usage, short limit, long limit) from a response's rate-limit
+    headers (the read limits for GETs, when sent), None if it has none"""
+    prefix = 'X-ReadRateLimit' if method == 'GET' and 'X-ReadRateLimit-Usage' in headers else 'X-RateLimit'
+    try:
+        short_usage, long_usage = (int(value) for value in headers[f"{prefix}-Usage"].split(','))
+        short_limit, long_limit = (int(value) for value in headers[f"{prefix}-Limit"].split(','))
+    except (KeyError, ValueError):
+        return None
+    return short_usage, long_usage, short_limit, long_limit
+
+
+def detail_priority(summary):
+    """Priority for fetching a summary activity's details: photo-bearing ones go last"""
+    return PHOTO if getattr(summary, 'total_photo_count', 0) else DETAIL
+
+
+class RateGovernor:
+    """Budgets Strava's 15-minute and daily rate limits across every API call in the process.
+
+    Strava limits are per application, so one governor is shared by all athletes'
+    clients. Usage is counted locally as requests are made and corrected from the
+    X-RateLimit headers on every response. Windows reset on the quarter hour and
+    at midnight UTC, like Strava's.
+    
+    fraction is the part of each limit this process's own requests may use: a shard
+    worker gets 1/SHARD_WORKERS, so shards can't starve each other, while the usage
+    Strava reports (everyone's) still counts against the whole limit.
+    """
+
+    def __init__(self, short_limit=None, long_limit=None, max_wait=None, fraction=1.0):
+        self.short_limit = short_limit or config.STRAVA_RATE_LIMIT_15MIN
+        self.long_limit = long_limit or config.STRAVA_RATE_LIMIT_DAILY
+        self.max_wait = config.STRAVA_RATE_MAX_WAIT_SECONDS if max_wait is None else max_wait
+        self.fraction = fraction
+        self.short_usage = 0
+        self.long_usage = 0
+        # Requests made by this process in the current windows
+        self.own_short_usage = 0
+        self.own_long_usage = 0
+        self._short_window = self._long_window = None
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._roll(time.time())
+
+    def _roll(self, now):
+        """Start counting from zero when a window resets"""
+        short_window = int(now // SHORT_WINDOW_SECONDS)
+        long_window = int(now // LONG_WINDOW_SECONDS)
+        if short_window != self._short_window:
+            self._short_window = short_window
+            self.short_usage = self.own_short_usage = 0
+        if long_window != self._long_window:
+            self._long_window = long_window
+            self.long_usage = self.own_long_usage = 0
+
+    def _wait_seconds(self, now, share):
+        if (self.long_usage >= self.long_limit * share or
+                self.own_long_usage >= self.long_limit * share * self.fraction):
+            return LONG_WINDOW_SECONDS - now % LONG_WINDOW_SECONDS
+        if (self.short_usage >= self.short_limit * share or
+                self.own_short_usage >= self.short_limit * share * self.fraction):
+            return SHORT_WINDOW_SECONDS - now % SHORT_WINDOW_SECONDS
+        return 0
+
+    @contextmanager
+    def priority(self, level):
+        """Send this thread's requests in the block at the given priority"""
+        previous = getattr(self._local, 'priority', None)
+        self._local.priority = level
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def acquire(self, url=''):
+        """Block until the budget allows a request to `url`.
+
+        Raises BudgetExhausted instead when that would take longer than max_wait
+        (e.g. the daily limit is spent), so the work can be left for a later run.
+        """
+        level = getattr(self._local, 'priority', None) or priority_for_url(url)
+        share = PRIORITY_SHARE[level]
+        with self._condition:
+            while True:
+                now = time.time()
+                self._roll(now)
+                wait = self._wait_seconds(now, share)
+                if not wait:
+                    self.short_usage += 1
+                    self.long_usage += 1
+                    self.own_short_usage += 1
+                    self.own_long_usage += 1
+                    return
+                if wait > self.max_wait:
+                    metrics.STRAVA_RATE_DEFERRED.inc(priority=level)
+                    raise BudgetExhausted(f"Strava rate limit budget for {level} requests is spent "
+                                          f"for the next {wait / 60:.0f} min")
+                metrics.STRAVA_RATE_WAITS.inc(priority=level)
+                log.warning(f"Strava rate limit nearly reached - holding {level} requests "
+                            f"for {wait:.0f}s", priority=level, wait_seconds=round(wait))
+                self._condition.wait(wait)
+
+    def update(self, response, *args, **kwargs):
+        """requests response hook: take the usage and limits Strava reports"""
+        # Only reads are governed by the (tighter) read limits; writes are rare
+        rates = None
+        if response.request.method == 'GET':
+            rates = rates_from_headers(response.headers, 'GET')
+        with self._condition:
+            now = time.time()
+            self._roll(now)
+            # Usage reported for a window that has since reset no longer applies
+            sent_at = now - response.elapsed.total_seconds()
+            if rates and int(sent_at // SHORT_WINDOW_SECONDS) == self._short_window:
+                short_usage, long_usage, self.short_limit, self.long_limit = rates
+                # Local counts include requests still in flight; the headers include other
+                # processes sharing the application
+                self.short_usage = max(self.short_usage, short_usage)
+                self.long_usage = max(self.long_usage, long_usage)
+            if response.status_code == 429:
+                # Over the limit anyway (another client, or a limit just lowered)
+                self.short_usage = max(self.short_usage, self.short_limit)
+            metrics.record_rates(self.short_usage, self.long_usage, self.short_limit, self.long_limit)
+
+    def remaining(self, level=DETAIL):
+        """Requests a priority may still make in the current windows"""
+        share = PRIORITY_SHARE[level]
+        with self._condition:
+            self._roll(time.time())
+            return max(0, int(min(self.short_limit * share - self.short_usage,
+                                  self.long_limit * share - self.long_usage,
+                                  self.short_limit * share * self.fraction - self.own_short_usage,
+                                  self.long_limit * share * self.fraction - self.own_long_usage)))
+
+
+# Shared by every StravaClient in the process
+governor = RateGovernor()
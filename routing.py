@@ -0,0 +1,87 @@
+"""
+Routing of activities to Teams channels.
+
+Without a routes file every activity is posted to TEAMS_WEBHOOK_URL. With one
+(TEAMS_ROUTES_FILE), each activity is posted to every channel with a matching rule:
+
+    {
+      "channels": {
+        "team": "https://example.webhook.office.com/...",
+        "cycling": "https://example.webhook.office.com/...",
+        "swimming": "https://example.webhook.office.com/..."
+      },
+      "routes": [
+        {"channel": "team", "types": ["Run"]},
+        {"channel": "cycling", "types": ["Ride", "VirtualRide"], "min_miles": 5},
+        {"channel": "swimming", "types": ["Swim"], "athletes": [12345, 67890]}
+      ]
+    }
+
+Every condition of a rule must match; a rule without conditions matches every
+activity. Activities that match no rule are not posted.
+"""
+
+import json
+import os
+import config
+from post_ledger import webhook_key
+
+# Channel name used when there is no routes file
+DEFAULT_CHANNEL = 'default'
+
+
+class Route:
+    """One routing rule: activities matching every given condition go to `channel`"""
+
+    def __init__(self, channel, types=None, athletes=None, min_miles=None, max_miles=None):
+        self.channel = channel
+        self.types = {t.lower() for t in types} if types else None
+        self.athletes = {int(a) for a in athletes} if athletes else None
+        self.min_miles = min_miles
+        self.max_miles = max_miles
+
+    def matches(self, activity):
+        if self.types is not None and (activity.type or '').lower() not in self.types:
+            return False
+        if self.athletes is not None and activity.athlete_id not in self.athletes:
+            return False
+        if self.min_miles is not None and activity.miles < self.min_miles:
+            return False
+        if self.max_miles is not None and activity.miles > self.max_miles:
+            return False
+        return True
+
+
+class Router:
+    """Maps activities to the Teams channels (name -> webhook URL) they are posted to"""
+
+    def __init__(self, path=None):
+        self.path = path or config.TEAMS_ROUTES_FILE
+        if not os.path.exists(self.path):
+            self.channels = {DEFAULT_CHANNEL: config.TEAMS_WEBHOOK_URL}
+            self.routes = [Route(DEFAULT_CHANNEL)]
+            return
+
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        self.channels = dict(data.get('channels') or {})
+        self.routes = []
+        for rule in data.get('routes') or []:
+            rule = dict(rule)
+            channel = rule.pop('channel', None)
+            if channel not in self.channels:
+                raise ValueError(f"{self.path}: route for unknown channel {channel!r}")
+            self.routes.append(Route(channel, **rule))
+
+        # The post ledger is keyed by webhook, so two names for one URL would share it
+        keys = [webhook_key(url) for url in self.channels.values()]
+        if len(set(keys)) != len(keys):
+            raise ValueError(f"{self.path}: two channels use the same webhook URL")
+
+    def channels_for(self, activity):
+        """Names of the channels an activity goes to, in routes-file order"""
+        names = []
+        for route in self.routes:
+            if route.channel not in names and route.matches(activity):
+                names.append(route.channel)
+        return names
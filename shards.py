@@ -0,0 +1,186 @@
+"""
+Sharded team runs for very large teams (SHARD_WORKERS > 1).
+
+One process caps out on a single core: fetching, rendering and queueing cards
+for thousands of athletes is CPU-bound long before Strava is. In sharded mode
+the main process coordinates a pool of long-lived worker processes, one per
+shard, and assigns every enrolled athlete to a shard by consistent hashing of
+their id. An athlete stays on the same worker from run to run (keeping their
+client, access token and profile warm), and changing SHARD_WORKERS moves only
+about 1/N of the team.
+
+Each worker fetches and renders for its own athletes, refreshes only their
+tokens and spends only its slice of the Strava rate limits. Cards go to the
+shared outbox, which the main process's sender drains, so every Teams channel
+still has one throttle. The coordinator merges what the shards return: digest
+activities (posted as one team digest), failures, metrics and team stats.
+"""
+
+import bisect
+import hashlib
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import config
+import log
+import metrics
+import team_stats
+from rate_governor import governor
+from sync_cursor import SyncCursor
+from teams_poster import TeamsPoster
+from token_store import TokenStore
+
+# Points per shard on the hash ring: enough to spread athletes within a few percent
+RING_REPLICAS = 100
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys (athlete ids) onto shards 0..count-1"""
+
+    def __init__(self, count, replicas=RING_REPLICAS):
+        self.count = count
+        points = sorted((_hash(f"shard-{shard}-{replica}"), shard)
+                        for shard in range(count) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        """The shard owning a key: the first point at or after its hash, going round"""
+        index = bisect.bisect_left(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+    def assign(self, keys):
+        """Keys grouped by shard, {shard: [key, ...]}, leaving out shards with none"""
+        shards = {}
+        for key in keys:
+            shards.setdefault(self.shard_for(key), []).append(key)
+        return shards
+
+
+def _run_shard(athlete_ids, dry_run):
+    """One run for a shard's athletes, in its worker; returns (fetched, failed)"""
+    # Deferred: main imports this module
+    import main
+    teams = TeamsPoster(dry_run=dry_run, send=False)
+    try:
+        return main.run_athletes(athlete_ids, TokenStore(), teams, SyncCursor())
+    finally:
+        teams.close()
+
+
+def _serve(shard, count, tasks, results):
+    """Worker process: run the shard's athletes for every task until told to stop"""
+    # The coordinator handles Ctrl-C and shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    governor.fraction = 1 / count
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        run_id, athlete_ids, dry_run = task
+        try:
+            fetched, failed = _run_shard(athlete_ids, dry_run)
+        except Exception as e:
+            log.error(f"✗ Shard {shard} failed: {str(e)}", shard=shard)
+            fetched, failed = [], list(athlete_ids)
+        results.put((run_id, shard, fetched, failed, metrics.collect()))
+
+
+class ShardPool:
+    """Long-lived worker processes, one per shard, and the coordinator side of a run"""
+
+    def __init__(self, count=None):
+        self.count = count or config.SHARD_WORKERS
+        self.ring = HashRing(self.count)
+        # Spawned, not forked: the scheduler process has threads (and their locks) running
+        self._context = multiprocessing.get_context('spawn')
+        self._results = self._context.Queue()
+        self._tasks = [None] * self.count
+        self._processes = [None] * self.count
+        self._run_id = 0
+        self._lock = threading.Lock()
+
+    def _start(self, shard):
+        """Start a shard's worker, unless it is already running (restarting one that died)"""
+        if self._processes[shard] is not None and self._processes[shard].is_alive():
+            return
+        self._tasks[shard] = self._context.Queue()
+        self._processes[shard] = self._context.Process(
+            target=_serve, args=(shard, self.count, self._tasks[shard], self._results),
+            name=f"shard-{shard}", daemon=True)
+        self._processes[shard].start()
+
+    def start(self):
+        """Start every shard's worker ahead of the first run (each takes a moment to import)"""
+        with self._lock:
+            for shard in range(self.count):
+                self._start(shard)
+
+    def run(self, athlete_ids, teams):
+        """Run every athlete on their shard's worker and merge the results.
+
+        teams is the coordinator's TeamsPoster: its sender delivers the cards the shards
+        queue, while they are still running. Returns (fetched, failed) like
+        main.run_athletes, over the whole team.
+        """
+        with self._lock:
+            self._run_id += 1
+            started = time.time()
+            waiting = self.ring.assign(athlete_ids)
+            for shard, ids in waiting.items():
+                self._start(shard)
+                self._tasks[shard].put((self._run_id, ids, teams.dry_run))
+
+            fetched = []
+            failed = []
+            while waiting:
+                try:
+                    run_id, shard, shard_fetched, shard_failed, samples = self._results.get(timeout=0.5)
+                except queue.Empty:
+                    # The sender only polls the outbox now and then; cards are waiting
+                    teams.sender.notify()
+                    for shard in list(waiting):
+                        if not self._processes[shard].is_alive():
+                            log.error(f"✗ Shard {shard} worker exited - failing its "
+                                      f"{len(waiting[shard])} athlete(s)", shard=shard)
+                            failed.extend(waiting.pop(shard))
+                    continue
+                metrics.merge(samples)
+                # A late result from a worker given up on in an earlier run
+                if run_id != self._run_id or shard not in waiting:
+                    continue
+                del waiting[shard]
+                fetched.extend(shard_fetched)
+                failed.extend(shard_failed)
+
+            team_stats.record_stored(started)
+            return fetched, failed
+
+    def close(self):
+        """Stop the workers once they finish their current task"""
+        for shard, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                self._tasks[shard].put(None)
+        for process in self._processes:
+            if process is not None:
+                process.join()
+
+
+# The scheduler's pool, started on first use and kept across runs
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The process's ShardPool (SHARD_WORKERS workers)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ShardPool()
+        return _pool
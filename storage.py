@@ -0,0 +1,21 @@
+import sqlite3
+import config
+
+
+def connect(path=None):
+    """Open a connection to the bot's local SQLite state database"""
+    conn = sqlite3.connect(path or config.STATE_DB, timeout=30)
+    # WAL lets fetch workers read while another thread writes
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def select_in(conn, sql, params, ids):
+    """Rows of a query matching a list of ids: sql has an `IN ({ids})` placeholder, bound
+    after params. Runs in chunks to stay under SQLite's bound-parameter limit."""
+    ids = list(ids)
+    rows = []
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        rows.extend(conn.execute(sql.format(ids=','.join('?' * len(chunk))), list(params) + chunk).fetchall())
+    return rows
@@ -1,27 +1,118 @@
-import json
-import os
-from datetime import datetime, timedelta
-from stravalib.client import Client
-from stravalib import unithelper
-import config
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import requests
-import urllib3
+from requests.adapters import HTTPAdapter
+import config
+import log
+import metrics
+import profiling
+from activity_cache import ActivityCache
+from activity_record import ActivityRecord
+from http_session import Session
+from photos import PhotoUrlCache
+from rate_governor import PHOTO, detail_priority, governor
+from token_store import TokenFile
+
+STRAVA_URL = 'https://www.strava.com'
+API_URL = f"{STRAVA_URL}/api/v3"
+
+# Largest page of summary activities Strava returns
+SUMMARY_PAGE_SIZE = 200
+
+# Per-request timeout, so a stalled connection can't hang a run
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+class _RedirectAdapter(HTTPAdapter):
+    """Sends requests for www.strava.com to config.STRAVA_API_URL (a proxy or stand-in API)"""
+    
+    def send(self, request, **kwargs):
+        request.url = config.STRAVA_API_URL.rstrip('/') + request.url[len(STRAVA_URL):]
+        return super().send(request, **kwargs)
+
+
+class _GovernedSession(Session):
+    """Session that waits for the shared rate-limit budget before every request"""
+    
+    def send(self, request, **kwargs):
+        governor.acquire(request.url)
+        return super().send(request, **kwargs)
+
+
+class StravaError(requests.HTTPError):
+    """Strava answered with an error status"""
 
-# Disable SSL warnings if SSL verification is disabled
-if not config.SSL_VERIFY:
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+class StravaApi:
+    """The few Strava API v3 calls a run makes, straight over a requests session.
+    
+    Responses are plain JSON: building stravalib's models (and importing stravalib,
+    most of a one-shot run's startup) is wasted on a run that reads a few fields.
+    """
+    
+    def __init__(self, session):
+        self.session = session
+        self.access_token = None
     
-    # Monkey patch requests to disable SSL verification globally
-    original_request = requests.Session.request
-    def patched_request(self, *args, **kwargs):
-        kwargs['verify'] = False
-        return original_request(self, *args, **kwargs)
-    requests.Session.request = patched_request
+    def _check(self, response):
+        if response.status_code < 400:
+            return response.json()
+        try:
+            detail = response.json()
+            detail = f"{detail.get('message', 'Undefined error')}: {detail.get('errors')}"
+        except ValueError:
+            detail = response.text[:200]
+        raise StravaError(f"{response.status_code} {response.reason} from Strava [{detail}]",
+                          response=response)
+    
+    def get(self, path, **params):
+        """GET an API path, filling {placeholders} in it from params; returns the JSON"""
+        path = path.format(**params)
+        params = {key: value for key, value in params.items() if f"{{{key}}}" not in path}
+        response = self.session.get(API_URL + path, params=params, timeout=REQUEST_TIMEOUT_SECONDS,
+                                    headers={'Authorization': f"Bearer {self.access_token}"})
+        return self._check(response)
+    
+    def refresh_access_token(self, client_id, client_secret, refresh_token):
+        """Exchange a refresh token for new tokens: {access_token, refresh_token, expires_at}"""
+        response = self.session.post(f"{STRAVA_URL}/oauth/token", timeout=REQUEST_TIMEOUT_SECONDS, data={
+            'client_id': client_id, 'client_secret': client_secret,
+            'refresh_token': refresh_token, 'grant_type': 'refresh_token'})
+        data = self._check(response)
+        self.access_token = data['access_token']
+        return {key: data[key] for key in ('access_token', 'refresh_token', 'expires_at')}
 
 
 class StravaClient:
-    def __init__(self):
-        self.client = Client()
+    def __init__(self, athlete_id=None, token_store=None):
+        # With a token store the client serves one enrolled athlete (team mode);
+        # otherwise it uses the single-athlete config.TOKEN_FILE
+        self.athlete_id = athlete_id
+        self.token_store = token_store
+        self.token_file = TokenFile() if token_store is None else None
+        self.athlete_name = None
+        self._athlete_name_expires_at = 0
+        
+        # Size the connection pool so concurrent detail fetches can reuse connections
+        session = _GovernedSession()
+        adapter = HTTPAdapter(pool_maxsize=max(config.FETCH_WORKERS, 10))
+        session.mount('https://', adapter)
+        if config.STRAVA_API_URL.rstrip('/') != STRAVA_URL:
+            session.mount(STRAVA_URL, _RedirectAdapter(pool_maxsize=max(config.FETCH_WORKERS, 10)))
+        # Count and time every API call, token refreshes included, and keep the
+        # rate-limit budget in step with the usage Strava reports
+        session.hooks['response'].append(metrics.record_strava_response)
+        session.hooks['response'].append(governor.update)
+        self.api = StravaApi(session)
+        self._client = None
+        self._token_lock = threading.Lock()
+        self.cache = ActivityCache() if config.ACTIVITY_CACHE_TTL_HOURS > 0 else None
+        self.photo_urls = PhotoUrlCache()
+        # Photo lookups for batches of activities (threads are started as needed)
+        self._photo_pool = ThreadPoolExecutor(max_workers=max(1, config.FETCH_WORKERS),
+                                              thread_name_prefix='photos')
         self.access_token = None
         self.refresh_token = config.STRAVA_REFRESH_TOKEN
         self.token_expires_at = None
@@ -29,68 +120,274 @@ class StravaClient:
         
     def _load_tokens(self):
         """Load saved tokens from file if available"""
-        if os.path.exists(config.TOKEN_FILE):
-            try:
-                with open(config.TOKEN_FILE, 'r') as f:
-                    data = json.load(f)
-                    self.access_token = data.get('access_token')
-                    self.refresh_token = data.get('refresh_token')
-                    self.token_expires_at = data.get('expires_at')
-                    # Set the access token on the client
-                    if self.access_token:
-                        self.client.access_token = self.access_token
-            except Exception as e:
-                print(f"Error loading tokens: {e}")
+        if self.token_store is not None:
+            data = self.token_store.get(self.athlete_id)
+            if data is None:
+                raise ValueError(f"Athlete {self.athlete_id} is not enrolled")
+            self._apply_tokens(data)
+            if data.get('name') and not self.athlete_name:
+                # Saved at enrollment; treated like a fresh profile lookup
+                self._set_athlete_name(data['name'])
+            return
+        
+        try:
+            data = self.token_file.get()
+        except Exception as e:
+            log.error(f"Error loading tokens: {e}")
+            return
+        if data:
+            self._apply_tokens(data)
+    
+    def _apply_tokens(self, data):
+        self.access_token = data.get('access_token')
+        self.refresh_token = data.get('refresh_token')
+        self.token_expires_at = data.get('expires_at')
+        # Set the access token on the clients
+        if self.access_token:
+            self.api.access_token = self.access_token
+            if self._client is not None:
+                self._client.access_token = self.access_token
+    
+    @property
+    def client(self):
+        """A stravalib Client on the same session, for the calls StravaApi doesn't
+        make (e.g. webhook subscriptions); stravalib is only imported when used"""
+        if self._client is None:
+            from stravalib.client import Client
+            from stravalib.util import limiter
+            # The shared governor replaces stravalib's limiter, which only sleeps once a
+            # limit has already been hit
+            self._client = Client(access_token=self.access_token, rate_limiter=limiter.RateLimiter(),
+                                  requests_session=self.api.session)
+        return self._client
     
     def _save_tokens(self, token_response):
-        """Save tokens to file"""
-        data = {
-            'access_token': token_response['access_token'],
-            'refresh_token': token_response['refresh_token'],
-            'expires_at': token_response['expires_at']
-        }
-        with open(config.TOKEN_FILE, 'w') as f:
-            json.dump(data, f)
-        
-        self.access_token = data['access_token']
-        self.refresh_token = data['refresh_token']
-        self.token_expires_at = data['expires_at']
+        """Save tokens to file (atomically, under the token file's lock)"""
+        if self.token_store is not None:
+            self.token_store.save(self.athlete_id, token_response)
+        else:
+            self.token_file.save(token_response)
+        self._apply_tokens(token_response)
+    
+    def _token_expired(self):
+        """True once the access token is missing or within the refresh margin of expiring"""
+        return not self.access_token or not self.token_expires_at or \
+            time.time() >= self.token_expires_at - config.TOKEN_REFRESH_MARGIN_SECONDS
     
     def _refresh_access_token(self):
-        """Refresh the access token if needed"""
-        if not self.access_token or not self.token_expires_at or \
-           datetime.now().timestamp() >= self.token_expires_at:
-            print("Refreshing Strava access token...")
-            token_response = self.client.refresh_access_token(
-                client_id=config.STRAVA_CLIENT_ID,
-                client_secret=config.STRAVA_CLIENT_SECRET,
-                refresh_token=self.refresh_token
-            )
-            self._save_tokens(token_response)
-            self.client.access_token = self.access_token
-    
-    def get_recent_activities(self, hours=24):
-        """Get activities from the last N hours"""
+        """Refresh the access token if needed (checked in memory; files are only touched to refresh)"""
+        if not self._token_expired():
+            return
+        # Only one fetch worker should refresh; the others wait and reuse the new token
+        with self._token_lock:
+            if not self._token_expired():
+                return
+            # Another process (or a re-enrollment) may have refreshed the tokens already
+            self._load_tokens()
+            if not self._token_expired():
+                return
+            log.info("Refreshing Strava access token...", athlete_id=self.athlete_id)
+            with profiling.span('_refresh_access_token', athlete=self.sync_key):
+                token_response = self.api.refresh_access_token(
+                    client_id=config.STRAVA_CLIENT_ID,
+                    client_secret=config.STRAVA_CLIENT_SECRET,
+                    refresh_token=self.refresh_token
+                )
+                self._save_tokens(token_response)
+    
+    def _set_athlete_name(self, name):
+        self.athlete_name = name
+        self._athlete_name_expires_at = time.time() + config.ATHLETE_PROFILE_TTL_HOURS * 3600
+    
+    def get_athlete_name(self):
+        """Display name of the athlete, looked up at most once per ATHLETE_PROFILE_TTL_HOURS"""
+        if not self.athlete_name or time.time() >= self._athlete_name_expires_at:
+            athlete = self.get_athlete()
+            self._set_athlete_name(f"{athlete.get('firstname') or ''} {athlete.get('lastname') or ''}".strip())
+        return self.athlete_name
+    
+    def remaining_requests(self):
+        """Detail requests the shared budget still allows in the current windows"""
+        return governor.remaining()
+    
+    @property
+    def sync_key(self):
+        """Key for this athlete's sync cursor"""
+        return str(self.athlete_id) if self.athlete_id is not None else 'self'
+    
+    def iter_summaries_after(self, after, on_page=None):
+        """Lazily page through summary activities that started after a UTC datetime.
+        
+        With `after` set, Strava returns the oldest activities first, so a long
+        catch-up is walked in order, 200 (the maximum page size) at a time.
+        Summaries are yielded as ActivityRecords built straight from the page JSON;
+        on_page, if given, is called with each page's raw JSON first.
+        """
+        after = int(after.timestamp())
+        page = 1
+        while True:
+            self._refresh_access_token()
+            with profiling.span('get_activities', athlete=self.sync_key, page=page) as stage:
+                summaries = self.api.get('/athlete/activities', after=after, page=page,
+                                         per_page=SUMMARY_PAGE_SIZE)
+                stage.set(activities=len(summaries))
+            if on_page is not None:
+                on_page(summaries)
+            for summary in summaries:
+                yield ActivityRecord.from_json(summary)
+            if len(summaries) < SUMMARY_PAGE_SIZE:
+                return
+            page += 1
+    
+    def get_summary_page(self, after, before=None):
+        """Raw JSON of the oldest page (up to 200) of summary activities that started
+        after a UTC datetime (and before another)"""
+        params = {'after': int(after.timestamp()), 'page': 1, 'per_page': SUMMARY_PAGE_SIZE}
+        if before is not None:
+            params['before'] = int(before.timestamp())
         self._refresh_access_token()
+        with profiling.span('get_activities', athlete=self.sync_key, after=params['after']):
+            return self.api.get('/athlete/activities', **params)
+    
+    def get_recent_activities(self, hours=24, after=None, on_page=None):
+        """Get activities from the last N hours (or after a UTC datetime)"""
+        if after is None:
+            after = datetime.now(timezone.utc) - timedelta(hours=hours)
+        summaries = list(self.iter_summaries_after(after, on_page=on_page))
+        # Unless cards show detail-only data, they are rendered from the summary (and maybe
+        # its photo)
+        to_fetch = summaries if cards_need_details() else []
+        photos = 0 if to_fetch else sum(1 for summary in summaries if needs_photo(summary))
+        metrics.ACTIVITY_SOURCES.inc(len(summaries) - len(to_fetch) - photos, source='summary')
+        metrics.ACTIVITY_SOURCES.inc(photos, source='photo')
+        metrics.ACTIVITY_SOURCES.inc(len(to_fetch), source='detail')
+        if not to_fetch:
+            return self.resolve_photos(summaries)
+        
+        # Get full activity details (which include photos) concurrently. Never run
+        # more workers than the requests left in the current rate-limit window; once
+        # the budget is spent the governor holds requests until it resets.
+        workers = max(1, min(config.FETCH_WORKERS, len(to_fetch), self.remaining_requests()))
         
-        after = datetime.now() - timedelta(hours=hours)
-        activities = self.client.get_activities(after=after)
+        # Photo-bearing activities are fetched last (and yield first under rate-limit
+        # pressure); results keep the same order as the summaries
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                activity.id: executor.submit(self.get_activity_details, activity.id,
+                                             priority=detail_priority(activity))
+                for activity in sorted(to_fetch, key=lambda a: detail_priority(a) == PHOTO)
+            }
+            activity_list = [futures[activity.id].result() if activity.id in futures else activity
+                             for activity in summaries]
         
-        # Convert to list and get full details for each activity to include photos
-        activity_list = []
-        for activity in activities:
-            # Get full activity details which includes photos
-            full_activity = self.get_activity_details(activity.id)
-            activity_list.append(full_activity)
+        if self.cache is not None:
+            self.cache.evict()
+        return self.resolve_photos(activity_list)
+    
+    def get_activity_details(self, activity_id, refresh=False, priority=None):
+        """Get detailed information about a specific activity (refresh=True skips the cache).
         
-        return activity_list
+        priority is the rate-limit priority for the request (rate_governor.DETAIL by default).
+        """
+        raw = self.cache.get(activity_id) if self.cache is not None and not refresh else None
+        if self.cache is not None:
+            metrics.STRAVA_CACHE.inc(result='hit' if raw is not None else 'miss')
+        if raw is None:
+            self._refresh_access_token()
+            # Same request as stravalib's Client.get_activity, keeping the raw JSON for the cache
+            with governor.priority(priority), profiling.span('get_activity', activity_id=activity_id):
+                raw = self.api.get('/activities/{id}', id=activity_id, include_all_efforts=False)
+            if self.cache is not None:
+                self.cache.put(activity_id, raw)
+        # A slim record is cheaper to build and hold than the full stravalib model
+        return ActivityRecord.from_json(raw)
     
-    def get_activity_details(self, activity_id):
-        """Get detailed information about a specific activity"""
+    def get_primary_photo_url(self, activity_id):
+        """URL of an activity's primary photo (600 px wide), None if there is none"""
         self._refresh_access_token()
-        return self.client.get_activity(activity_id)
+        with profiling.span('get_activity_photos', activity_id=activity_id):
+            photos = self.api.get('/activities/{id}/photos', id=activity_id, size=600,
+                                  photo_sources='true')
+        primary = next((photo for photo in photos if photo.get('default_photo')), photos[0] if photos else None)
+        urls = (primary or {}).get('urls') or {}
+        return urls.get('600') or next(iter(urls.values()), None)
+    
+    def _lookup_photo(self, activity_id):
+        # Priorities are per thread
+        with governor.priority(PHOTO):
+            return self.get_primary_photo_url(activity_id)
+    
+    def resolve_photo(self, activity):
+        """resolve_photos for a single activity, looked up in the calling thread (e.g. a
+        pipeline fetch worker); returns it"""
+        if not needs_photo(activity):
+            return activity
+        url = self.photo_urls.get_many([activity.id]).get(activity.id)
+        if url is None:
+            url = self._lookup_photo(activity.id)
+            self.photo_urls.put_many({activity.id: url})
+        activity.photo_url = url or None
+        return activity
+    
+    def resolve_photos(self, activities):
+        """Fill in photo_url for activities whose summary says they have photos; returns them.
+        
+        URLs are looked up once per activity and remembered. Lookups use Strava's photos
+        endpoint, concurrently and at photo priority: a much smaller response than the
+        activity details, which are only needed for detail-only fields.
+        """
+        pending = [activity for activity in activities if needs_photo(activity)]
+        if not pending:
+            return activities
+        known = self.photo_urls.get_many(activity.id for activity in pending)
+        missing = [activity.id for activity in pending if activity.id not in known]
+        if missing:
+            found = dict(zip(missing, self._photo_pool.map(self._lookup_photo, missing)))
+            self.photo_urls.put_many(found)
+            known.update(found)
+        for activity in pending:
+            activity.photo_url = known[activity.id] or None
+        return activities
     
     def get_athlete(self):
-        """Get the authenticated athlete's profile"""
+        """Get the authenticated athlete's profile (JSON)"""
         self._refresh_access_token()
-        return self.client.get_athlete()
+        with profiling.span('get_athlete', athlete=self.sync_key):
+            return self.api.get('/athlete')
+
+
+def cards_need_details():
+    """Whether cards show detail-only data (see CARD_DETAIL_FIELDS). A description or
+    calories never come with summaries, so then every activity needs a detail request."""
+    fields = config.CARD_DETAIL_FIELDS
+    return 'description' in fields or 'calories' in fields
+
+
+def needs_photo(activity):
+    """Whether an ActivityRecord has photos its card should show but no photo URL yet"""
+    return ('photos' in config.CARD_DETAIL_FIELDS and activity.total_photo_count > 0
+            and not activity.photo_url)
+
+
+# Long-lived clients, one per athlete, shared by every run of the process
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(athlete_id=None, token_store=None):
+    """The process's client for an athlete (the single-athlete one without an id).
+    
+    Reusing it across runs keeps its access token, athlete profile and connection
+    pool, instead of re-reading the token file and looking up the athlete every run.
+    """
+    key = str(athlete_id) if athlete_id is not None else None
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = StravaClient(athlete_id=athlete_id, token_store=token_store)
+        return _clients[key]
+
+
+def forget_client(athlete_id=None):
+    """Drop an athlete's cached client (e.g. after they revoke access)"""
+    with _clients_lock:
+        _clients.pop(str(athlete_id) if athlete_id is not None else None, None)
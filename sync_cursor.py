@@ -0,0 +1,53 @@
+import time
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+import config
+import storage
+
+
+class SyncCursor:
+    """Persisted high-water mark of the newest activity start time handled, per athlete.
+
+    Every activity that started at or before the mark has been posted (or was already
+    in the ledger), so the next run only asks Strava for activities after it.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_cursor (
+                    athlete TEXT PRIMARY KEY,
+                    synced_until REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+
+    def get(self, athlete):
+        """Timestamp of the high-water mark, or None if the athlete never synced"""
+        with closing(storage.connect(self.path)) as conn:
+            row = conn.execute("SELECT synced_until FROM sync_cursor WHERE athlete = ?",
+                               (str(athlete),)).fetchone()
+        return row[0] if row else None
+
+    def save(self, athlete, synced_until):
+        """Move the high-water mark forward (never backwards)"""
+        with closing(storage.connect(self.path)) as conn, conn:
+            conn.execute("""
+                INSERT INTO sync_cursor (athlete, synced_until, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (athlete) DO UPDATE SET
+                    synced_until = MAX(synced_until, excluded.synced_until),
+                    updated_at = excluded.updated_at
+            """, (str(athlete), synced_until, time.time()))
+
+    def start_after(self, athlete):
+        """UTC datetime to request activities after.
+
+        Without a mark this is the LOOKBACK_HOURS window; otherwise the mark minus
+        SYNC_OVERLAP_HOURS, which catches activities uploaded late (the posting ledger
+        keeps the overlap from being posted twice).
+        """
+        synced_until = self.get(athlete)
+        if synced_until is None:
+            return datetime.now(timezone.utc) - timedelta(hours=config.LOOKBACK_HOURS)
+        return datetime.fromtimestamp(synced_until, timezone.utc) - timedelta(hours=config.SYNC_OVERLAP_HOURS)
@@ -0,0 +1,233 @@
+"""
+Team statistics for the weekly and monthly leaderboards.
+
+TeamStats keeps per-athlete and per-type daily totals (distance, moving time,
+elevation gain and activity count) for a rolling window of days in NumPy
+arrays. It is loaded from the activity store once, then updated as runs store
+new activities, so a leaderboard never rescans history.
+"""
+
+import threading
+from datetime import datetime, time, timedelta
+import numpy as np
+import pytz
+import activity_store
+import config
+from activity_record import ActivityRecord
+from activity_store import ActivityStore
+
+# Value fields, in array order
+FIELDS = ('distance', 'moving_time', 'elevation', 'count')
+DISTANCE, MOVING_TIME, ELEVATION, COUNT = range(len(FIELDS))
+
+
+def today():
+    """The team's current date (in config.TIMEZONE)"""
+    return datetime.now(pytz.timezone(config.TIMEZONE)).date()
+
+
+def last_period(period, day=None):
+    """(first day, day after the last) of the last full 'week' (Monday to Sunday) or 'month'"""
+    day = day or today()
+    if period == 'week':
+        until = day - timedelta(days=day.weekday())
+        return until - timedelta(days=7), until
+    if period == 'month':
+        until = day.replace(day=1)
+        return (until - timedelta(days=1)).replace(day=1), until
+    raise ValueError(f"Unknown leaderboard period: {period!r}")
+
+
+def _trailing_run(active):
+    """Length of the run of True at the end of each row"""
+    # The first False counting from the end marks where the run starts
+    inactive_from_end = ~active[:, ::-1]
+    return np.where(inactive_from_end.any(axis=1), inactive_from_end.argmax(axis=1), active.shape[1])
+
+
+class TeamStats:
+    """Rolling per-athlete, per-day totals for the last `days` days.
+
+    Leaderboards and streaks only need totals per athlete and type totals only team
+    wide, so two arrays are kept rather than their full cross product:
+    athlete_values has shape (field, athlete, day) and type_values (field, type,
+    day). Column 0 is the oldest day of the window and column -1 today. Days are
+    the athletes' local dates. Rows are allocated in growing blocks, so only the
+    first len(athletes) / len(types) rows are in use.
+    """
+
+    def __init__(self, days=None):
+        self.days = days or config.TEAM_STATS_DAYS
+        self.end = today()
+        self.athletes = []
+        self.types = []
+        self._athlete_rows = {}
+        self._type_rows = {}
+        self._athlete_values = np.zeros((len(FIELDS), 0, self.days))
+        self._type_values = np.zeros((len(FIELDS), 0, self.days))
+        # Each activity's contribution (type row, athlete row, date ordinal, values), so
+        # an updated activity replaces its old values instead of adding to them
+        self._activities = {}
+        self._lock = threading.Lock()
+
+    @property
+    def athlete_values(self):
+        return self._athlete_values[:, :len(self.athletes)]
+
+    @property
+    def type_values(self):
+        return self._type_values[:, :len(self.types)]
+
+    @property
+    def start(self):
+        """First day of the window"""
+        return self.end - timedelta(days=self.days - 1)
+
+    def _advance(self):
+        """Roll the window forward to today, dropping the days that fall out of it"""
+        shift = (today() - self.end).days
+        if shift <= 0:
+            return
+        self.end += timedelta(days=shift)
+        for values in (self._athlete_values, self._type_values):
+            if shift < self.days:
+                values[..., :-shift] = values[..., shift:]
+            values[..., -min(shift, self.days):] = 0
+        first = self.start.toordinal()
+        self._activities = {activity_id: entry for activity_id, entry in self._activities.items()
+                            if entry[2] >= first}
+
+    @staticmethod
+    def _grow(values, rows):
+        """values with room for at least `rows` rows, doubling its capacity as needed"""
+        if rows <= values.shape[1]:
+            return values
+        grown = np.zeros((values.shape[0], max(rows, 2 * values.shape[1], 16), values.shape[2]))
+        grown[:, :values.shape[1]] = values
+        return grown
+
+    @staticmethod
+    def _rows(keys, names, rows):
+        """Rows for keys, adding rows for new keys"""
+        for key in keys:
+            if key not in rows:
+                rows[key] = len(names)
+                names.append(key)
+        return np.array([rows[key] for key in keys], dtype=np.intp)
+
+    def add(self, activities):
+        """Add (or update) activities, given as (athlete, ActivityRecord) pairs"""
+        with self._lock:
+            self._advance()
+            first = self.start.toordinal()
+            entries = {}
+            for athlete, activity in activities:
+                day = activity.start_date_local.date().toordinal()
+                if first <= day <= self.end.toordinal():
+                    entries[activity.id] = (activity.type, str(athlete), day,
+                                            (activity.distance, activity.moving_time,
+                                             activity.total_elevation_gain, 1))
+            if not entries:
+                return
+
+            type_rows = self._rows([entry[0] for entry in entries.values()], self.types, self._type_rows)
+            athlete_rows = self._rows([entry[1] for entry in entries.values()], self.athletes,
+                                      self._athlete_rows)
+            self._type_values = self._grow(self._type_values, len(self.types))
+            self._athlete_values = self._grow(self._athlete_values, len(self.athletes))
+            days = np.array([entry[2] for entry in entries.values()]) - first
+            values = np.array([entry[3] for entry in entries.values()], dtype=float)
+
+            # Take back what updated activities contributed before
+            old = [self._activities[activity_id] for activity_id in entries if activity_id in self._activities]
+            if old:
+                old_types, old_athletes, old_days, old_values = zip(*old)
+                old_days = np.array(old_days) - first
+                old_values = np.array(old_values).T
+                np.subtract.at(self._type_values, (slice(None), np.array(old_types), old_days), old_values)
+                np.subtract.at(self._athlete_values, (slice(None), np.array(old_athletes), old_days), old_values)
+
+            np.add.at(self._type_values, (slice(None), type_rows, days), values.T)
+            np.add.at(self._athlete_values, (slice(None), athlete_rows, days), values.T)
+            for i, activity_id in enumerate(entries):
+                self._activities[activity_id] = (type_rows[i], athlete_rows[i], days[i] + first, values[i])
+
+    def load(self, store=None, stored_since=None):
+        """Add everything in the activity store that falls in the window (or only what
+        was stored since a time, epoch seconds)"""
+        store = store or ActivityStore()
+        # Start times are UTC; a day's margin covers athletes ahead of it
+        since = datetime.combine(self.start - timedelta(days=1), time(), tzinfo=pytz.utc)
+        batch = []
+        for item in store.iter_activities(since=since, stored_since=stored_since):
+            batch.append(item)
+            if len(batch) >= 10000:
+                self.add(batch)
+                batch = []
+        self.add(batch)
+        return self
+
+    def _columns(self, since, until):
+        """Day columns for since <= day < until (dates)"""
+        lo = min(max(0, (since - self.start).days), self.days)
+        hi = min(max(0, (until - self.start).days), self.days)
+        return slice(lo, max(lo, hi))
+
+    def leaderboard(self, since, until, limit=None):
+        """Athletes active from since to before until, by distance, as dicts of totals
+        (athlete, distance, moving_time, elevation, count) plus their current streak"""
+        with self._lock:
+            self._advance()
+            # (field, athlete) totals over every day of the period
+            totals = self.athlete_values[:, :, self._columns(since, until)].sum(axis=2)
+            streaks = self._current_streaks()
+            order = [row for row in np.argsort(-totals[DISTANCE], kind='stable') if totals[COUNT][row] > 0]
+            board = []
+            for row in order[:limit]:
+                entry = {'athlete': self.athletes[row], 'streak': int(streaks[row])}
+                entry.update((field, float(totals[i][row])) for i, field in enumerate(FIELDS))
+                entry['count'] = int(entry['count'])
+                board.append(entry)
+            return board
+
+    def type_totals(self, since, until):
+        """Team totals per activity type from since to before until: {type: {field: value}}"""
+        with self._lock:
+            self._advance()
+            totals = self.type_values[:, :, self._columns(since, until)].sum(axis=2)
+            return {activity_type: dict({field: float(totals[i][row]) for i, field in enumerate(FIELDS)},
+                                        count=int(totals[COUNT][row]))
+                    for row, activity_type in enumerate(self.types) if totals[COUNT][row] > 0}
+
+    def _current_streaks(self):
+        """Consecutive active days per athlete, up to today (or yesterday, if nothing yet today)"""
+        active = self.athlete_values[COUNT] > 0
+        # A streak is only broken once a whole day passes without an activity
+        return np.where(active[:, -1], _trailing_run(active), _trailing_run(active[:, :-1]))
+
+
+# The scheduler's stats, loaded from the activity store on first use
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def _record(athlete, summaries):
+    # Activities this process stores from then on (run pages, backfills)
+    _stats.add((athlete, ActivityRecord.from_json(summary)) for summary in summaries)
+
+
+def get_stats():
+    """The process's TeamStats, loaded from the store the first time"""
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            _stats = TeamStats().load()
+            activity_store.add_listener(_record)
+        return _stats
+
+
+def record_stored(stored_since):
+    """Count activities other processes (shard workers) stored since a time (epoch
+    seconds) in the team stats, if they are loaded"""
+    if _stats is not None:
+        _stats.load(stored_since=stored_since)
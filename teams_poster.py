@@ -1,280 +1,277 @@
-import requests
+import json
 from datetime import datetime
 import config
+import log
+import metrics
+import profiling
+from card_renderer import CardRenderer
+from outbox import Outbox, OutboxSender
+from photos import PhotoCache
+from post_ledger import PostLedger
+from routing import DEFAULT_CHANNEL, Router
+from webhook_transport import WebhookTransport
 
 
 class TeamsPoster:
-    def __init__(self, dry_run=False):
-        self.webhook_url = config.TEAMS_WEBHOOK_URL
+    def __init__(self, dry_run=False, router=None, send=True, sender=None):
+        self.router = router or Router()
         self.dry_run = dry_run
+        # A shard worker only queues cards; the main process's sender delivers them
+        self.send = send
+        self.ledger = PostLedger()
+        self.renderer = CardRenderer()
+        self.photos = PhotoCache()
+        # Cards are queued durably and sent in the background, each channel by its own
+        # workers over its own connection pool and throttle. The scheduler passes its
+        # long-lived sender, which keeps sending (and retrying) between runs.
+        self.outbox = Outbox()
+        self.owns_sender = sender is None
+        self.sender = OutboxSender(self.outbox, self.ledger) if sender is None else sender
+        if not dry_run and send:
+            for channel, url in self.router.channels.items():
+                if url:
+                    self.sender.add_webhook(url, WebhookTransport(channel=channel), channel=channel)
+            # Also resends anything an earlier, interrupted run left queued
+            self.sender.start()
     
     def format_activity_card(self, activity, athlete_name=None):
-        """Format a Strava activity as a Teams Adaptive Card"""
-        
-        # Format date
-        activity_date = activity.start_date_local
-        date_str = activity_date.strftime('%A, %B %d, %Y')
-        time_str = activity_date.strftime('%I:%M %p')
-        
-        # Convert units
-        # Strava API returns distance in meters
-        # For swimming, display in yards; for others, display in miles
-        if activity.type == 'Swim':
-            distance_yards = float(activity.distance) * 1.09361 if activity.distance else 0
-            distance_display = f"{distance_yards:.0f} yd"
-        else:
-            distance_miles = float(activity.distance) * 0.000621371 if activity.distance else 0
-            distance_display = f"{distance_miles:.2f} mi"
-        
-        moving_time_seconds = int(activity.moving_time.total_seconds()) if activity.moving_time else 0
-        elapsed_time_seconds = int(activity.elapsed_time.total_seconds()) if activity.elapsed_time else 0
-        elevation_feet = float(activity.total_elevation_gain) * 3.28084 if activity.total_elevation_gain else 0
-        
-        # Format time
-        hours = moving_time_seconds // 3600
-        minutes = (moving_time_seconds % 3600) // 60
-        seconds = moving_time_seconds % 60
-        if hours > 0:
-            time_formatted = f"{hours}h {minutes}m {seconds}s"
-        else:
-            time_formatted = f"{minutes}m {seconds}s"
-        
-        # Build facts (stats)
-        facts = []
-        
-        # Distance
-        if activity.type == 'Swim' and distance_yards > 0:
-            facts.append({
-                "title": "Distance",
-                "value": f"{distance_yards:.0f} yd"
-            })
-        elif activity.type != 'Swim' and distance_miles > 0:
-            facts.append({
-                "title": "Distance",
-                "value": f"{distance_miles:.2f} mi"
-            })
-        
-        # Time
-        if moving_time_seconds > 0:
-            facts.append({
-                "title": "Time",
-                "value": time_formatted
-            })
-        
-        # Pace/Speed
-        if activity.type == 'Swim' and distance_yards > 0:
-            pace_seconds_per_100yd = (moving_time_seconds / distance_yards) * 100
-            pace_minutes = int(pace_seconds_per_100yd // 60)
-            pace_secs = int(pace_seconds_per_100yd % 60)
-            facts.append({
-                "title": "Pace",
-                "value": f"{pace_minutes}:{pace_secs:02d} /100yd"
-            })
-        elif activity.type != 'Swim' and distance_miles > 0:
-            if activity.type in ['Run', 'Walk', 'Hike']:
-                pace_seconds = moving_time_seconds / distance_miles
-                pace_minutes = int(pace_seconds // 60)
-                pace_secs = int(pace_seconds % 60)
-                facts.append({
-                    "title": "Pace",
-                    "value": f"{pace_minutes}:{pace_secs:02d} /mi"
-                })
-            else:
-                speed_mph = distance_miles / (moving_time_seconds / 3600)
-                facts.append({
-                    "title": "Speed",
-                    "value": f"{speed_mph:.1f} mph"
-                })
-        
-        # Elevation
-        if elevation_feet > 0:
-            facts.append({
-                "title": "Elevation",
-                "value": f"{elevation_feet:.0f} ft"
-            })
-        
-        # Heart rate
-        if hasattr(activity, 'average_heartrate') and activity.average_heartrate:
-            facts.append({
-                "title": "Avg HR",
-                "value": f"{activity.average_heartrate:.0f} bpm"
-            })
-        
-        if hasattr(activity, 'max_heartrate') and activity.max_heartrate:
-            facts.append({
-                "title": "Max HR",
-                "value": f"{activity.max_heartrate:.0f} bpm"
-            })
-        
-        # Calories
-        if hasattr(activity, 'calories') and activity.calories:
-            facts.append({
-                "title": "Calories",
-                "value": f"{activity.calories:.0f}"
-            })
-        
-        # Build the adaptive card
-        card = {
-            "type": "message",
-            "attachments": [
-                {
-                    "contentType": "application/vnd.microsoft.card.adaptive",
-                    "content": {
-                        "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-                        "type": "AdaptiveCard",
-                        "version": "1.4",
-                        "body": []
-                    }
-                }
-            ]
-        }
-        
-        body = card["attachments"][0]["content"]["body"]
-        
-        # Add header image if available
-        photo_url = None
-        if hasattr(activity, 'photos') and hasattr(activity.photos, 'primary') and activity.photos.primary:
-            # Use the primary photo
-            photo_url = activity.photos.primary.urls.get('600') or activity.photos.primary.urls.get('1000')
-        elif hasattr(activity, 'total_photo_count') and activity.total_photo_count > 0:
-            # If photos exist but we don't have the URL in summary, we'd need to fetch full activity
-            # For now, we'll skip this to avoid extra API calls
-            pass
-        
-        if photo_url:
-            body.append({
-                "type": "Image",
-                "url": photo_url,
-                "size": "Stretch"
-            })
+        """Format an ActivityRecord as a Teams Adaptive Card (as a dict)"""
+        return json.loads(self.renderer.card(activity, athlete_name=athlete_name))
+    
+    def format_digest_cards(self, activities, athlete_name=None, athlete_names=None, sections=None):
+        """Pack several activities into as few Adaptive Cards as the Teams size limit allows.
         
-        # Title
-        body.append({
-            "type": "TextBlock",
-            "text": activity.name,
-            "size": "Large",
-            "weight": "Bolder"
-        })
+        Each activity is a collapsible section: its title is always shown and clicking it
+        expands the rest of its card body. For team digests, athlete_names maps activity
+        id to the athlete shown under each title. sections, if given, caches rendered
+        sections by activity id across calls.
+        Returns the encoded cards and the number of activities in each.
+        """
+        # Sections are rendered straight to bytes, so their size is known without re-encoding
+        sections = {} if sections is None else sections
+        with profiling.span('format_digest_cards', activities=len(activities)):
+            for activity in activities:
+                if activity.id not in sections:
+                    sections[activity.id] = self.renderer.digest_section(
+                        activity, athlete_name=(athlete_names or {}).get(activity.id))
+        sections = [sections[activity.id] for activity in activities]
         
-        # Athlete name
-        if athlete_name:
-            body.append({
-                "type": "TextBlock",
-                "text": f"by {athlete_name}",
-                "size": "Small",
-                "weight": "Lighter",
-                "color": "Accent",
-                "spacing": "None"
-            })
+        # Split into messages by size, leaving room for the envelope and heading
+        budget = config.TEAMS_MAX_PAYLOAD_BYTES - 1024
+        batches = [[]]
+        batch_size = 0
+        for section in sections:
+            section_size = len(section) + 1
+            if batches[-1] and batch_size + section_size > budget:
+                batches.append([])
+                batch_size = 0
+            batches[-1].append(section)
+            batch_size += section_size
         
-        # Date and time
-        if config.SHOW_WORKOUT_TIME:
-            date_time_text = f"{date_str} at {time_str}"
-        else:
-            date_time_text = date_str
-        body.append({
-            "type": "TextBlock",
-            "text": date_time_text,
-            "size": "Small",
-            "color": "Default",
-            "spacing": "None"
-        })
+        cards = []
+        for part, batch in enumerate(batches, start=1):
+            heading = f"{len(batch)} new activit{'y' if len(batch) == 1 else 'ies'}"
+            if athlete_name:
+                heading = f"{athlete_name}: {heading}"
+            if len(batches) > 1:
+                heading += f" ({part}/{len(batches)})"
+            cards.append(self.renderer.message([self.renderer.heading(heading)] + batch))
+        return cards, [len(batch) for batch in batches]
+    
+    def _posted_to(self, activity_ids, channel):
+        """The subset of activity_ids already posted, or queued to be posted, to a channel"""
+        url = self.router.channels[channel]
+        return self.ledger.posted_ids(activity_ids, url) | self.outbox.queued_ids(activity_ids, url)
+    
+    def posted_anywhere(self, activity_ids):
+        """The subset of activity_ids already posted, or queued to be posted, to any channel.
         
-        # Activity type
-        body.append({
-            "type": "TextBlock",
-            "text": activity.type,
-            "size": "Small",
-            "weight": "Lighter",
-            "spacing": "None"
-        })
+        An activity is queued for all the channels it is routed to at once, so one that
+        any channel holds has been handled (unrouted channels never will hold it).
+        """
+        activity_ids = list(activity_ids)
+        posted = set()
+        for channel in self.router.channels:
+            posted |= self._posted_to(activity_ids, channel)
+        return posted
+    
+    def _targets(self, activities):
+        """Channels each activity (by id) still goes to: those it is routed to, less any a
+        previous (or overlapping) run already posted it to"""
+        routed = {activity.id: self.router.channels_for(activity) for activity in activities}
+        ids = list(routed)
+        posted = {channel: self._posted_to(ids, channel) for channel in set().union(*routed.values())}
+        return {activity_id: [channel for channel in channels if activity_id not in posted[channel]]
+                for activity_id, channels in routed.items()}
+    
+    def unposted_channels(self, activity):
+        """Channels an activity still has to be posted to (empty if there are none)"""
+        return self._targets([activity])[activity.id]
+    
+    def _unposted(self, activities):
+        """Drop activities with no channel left to post to; returns the rest and their channels"""
+        targets = self._targets(activities)
+        skipped = sum(1 for activity in activities if not targets[activity.id])
+        if skipped:
+            log.info(f"Skipping {skipped} already-posted or unrouted activity(ies)", skipped=skipped)
+            activities = [a for a in activities if targets[a.id]]
+        return activities, targets
+    
+    def _enqueue(self, card, activity_ids, label, channels):
+        """Queue a card for the sender, once per channel; True once it is safely on disk"""
+        try:
+            self.outbox.enqueue([self.router.channels[channel] for channel in channels], card,
+                                activity_ids, label=label)
+        except Exception as e:
+            log.error(f"✗ Error queueing {label} - {str(e)}", activity_ids=activity_ids)
+            return False
+        self.sender.notify()
+        return True
+    
+    def _print_channels(self, channels):
+        if channels != [DEFAULT_CHANNEL]:
+            print(f"Channels: {', '.join(channels)}")
+    
+    def post_digest(self, activities, athlete_name=None, athlete_names=None):
+        """Queue activities as digest cards, one webhook call per card.
         
-        # Stats
-        if facts:
-            body.append({
-                "type": "FactSet",
-                "facts": facts,
-                "spacing": "Medium"
-            })
+        Returns True only if every card was queued.
+        """
+        activities, targets = self._unposted(activities)
+        if not activities:
+            log.info("No new activities to post")
+            return True
         
-        # Description if available
-        if activity.description:
-            body.append({
-                "type": "TextBlock",
-                "text": activity.description,
-                "wrap": True,
-                "spacing": "Medium"
-            })
+        for activity in activities:
+            self.photos.localize(activity)
         
-        # Link to activity
-        body.append({
-            "type": "ActionSet",
-            "actions": [
-                {
-                    "type": "Action.OpenUrl",
-                    "title": "View on Strava",
-                    "url": f"https://www.strava.com/activities/{activity.id}"
-                }
-            ]
-        })
+        # Each channel gets a digest of its own activities; channels getting the same
+        # activities share the same cards, and every section is rendered only once
+        groups = {}
+        for channel in self.router.channels:
+            batch = [activity for activity in activities if channel in targets[activity.id]]
+            if batch:
+                groups.setdefault(tuple(a.id for a in batch), (batch, []))[1].append(channel)
         
-        return card
+        sections = {}
+        ok = True
+        for batch, channels in groups.values():
+            cards, counts = self.format_digest_cards(batch, athlete_name=athlete_name,
+                                                     athlete_names=athlete_names, sections=sections)
+            start = 0
+            for card, count in zip(cards, counts):
+                part = batch[start:start + count]
+                start += count
+                if self.dry_run:
+                    print(f"\n{'='*60}")
+                    print(f"DIGEST: {count} activity(ies)")
+                    self._print_channels(channels)
+                    print(f"{'='*60}")
+                    print(json.dumps(json.loads(card), indent=2))
+                    print(f"{'='*60}\n")
+                    continue
+                
+                ok = self._enqueue(card, [activity.id for activity in part],
+                                   f"digest of {count} activity(ies)", channels) and ok
+        return ok
     
     def post_activities(self, activities, athlete_name=None):
         """Post activities to Teams"""
         if not activities:
-            print("No activities to post")
-            return
+            log.info("No activities to post")
+            return True
+        
+        activities, targets = self._unposted(activities)
         
+        # Returns True only if every activity was queued
+        ok = True
         for activity in activities:
-            card = self.format_activity_card(activity, athlete_name=athlete_name)
-            if self.dry_run:
-                print(f"\n{'='*60}")
-                print(f"ACTIVITY: {activity.name}")
-                print(f"{'='*60}")
-                print(f"Type: {activity.type}")
-                print(f"Date: {activity.start_date_local}")
-                print(f"Distance: {float(activity.distance) * 0.000621371:.2f} mi" if activity.distance else "Distance: N/A")
-                print(f"Time: {activity.moving_time}" if activity.moving_time else "Time: N/A")
-                print(f"Elevation: {float(activity.total_elevation_gain) * 3.28084:.0f} ft" if activity.total_elevation_gain else "Elevation: N/A")
-                if hasattr(activity, 'average_heartrate') and activity.average_heartrate:
-                    print(f"Avg HR: {activity.average_heartrate:.0f} bpm")
-                if hasattr(activity, 'calories') and activity.calories:
-                    print(f"Calories: {activity.calories:.0f}")
-                print(f"\nCard JSON:")
-                import json
-                print(json.dumps(card, indent=2))
-                print(f"{'='*60}\n")
-                continue
-            
-            if self.dry_run:
-                print("\n" + "="*60)
-                print("No activities in the last 24 hours. Rest day! 😴")
-                print("="*60 + "\n")
-                return
-                
-            
-            try:
-                response = requests.post(
-                    self.webhook_url,
-                    json=card,
-                    headers={'Content-Type': 'application/json'}
-                )
-                
-                if response.status_code in [200, 202]:
-                    print(f"✓ Posted activity: {activity.name}")
-                else:
-                    print(f"✗ Failed to post activity: {activity.name} - Status: {response.status_code}")
-                    print(f"  Response: {response.text}")
-            except Exception as e:
-                print(f"✗ Error posting activity: {activity.name} - {str(e)}")
+            ok = self._post(activity, targets[activity.id], athlete_name) and ok
+        return ok
+    
+    def post_activity(self, activity, athlete_name=None):
+        """Post a single activity card to every channel it still goes to, returning True on success"""
+        return self._post(activity, self.unposted_channels(activity), athlete_name)
+    
+    def _post(self, activity, channels, athlete_name):
+        if not channels:
+            return True
+        # Rendered once, whatever the number of channels
+        self.photos.localize(activity)
+        with profiling.span('format_activity_card', activity_id=activity.id):
+            card = self.renderer.card(activity, athlete_name=athlete_name)
+        if self.dry_run:
+            # One write per activity: post workers print concurrently
+            lines = ['', '=' * 60, f"ACTIVITY: {activity.name}"]
+            if channels != [DEFAULT_CHANNEL]:
+                lines.append(f"Channels: {', '.join(channels)}")
+            lines += ['=' * 60,
+                      f"Type: {activity.type}",
+                      f"Date: {activity.start_date_local}",
+                      f"Distance: {activity.miles:.2f} mi" if activity.distance else "Distance: N/A",
+                      f"Time: {activity.moving_time_text}" if activity.moving_time else "Time: N/A",
+                      f"Elevation: {activity.feet:.0f} ft" if activity.total_elevation_gain else "Elevation: N/A"]
+            if activity.average_heartrate:
+                lines.append(f"Avg HR: {activity.average_heartrate:.0f} bpm")
+            if activity.calories:
+                lines.append(f"Calories: {activity.calories:.0f}")
+            lines += ['', "Card JSON:", json.dumps(json.loads(card), indent=2), '=' * 60, '', '']
+            print('\n'.join(lines), end='', flush=True)
+            return True
+        
+        return self._enqueue(card, [activity.id], f"activity: {activity.name}", channels)
+    
+    def post_leaderboard(self, card, label):
+        """Queue a leaderboard card for the LEADERBOARD_CHANNELS (default: every channel)"""
+        channels = [channel for channel in self.router.channels
+                    if not config.LEADERBOARD_CHANNELS or channel in config.LEADERBOARD_CHANNELS]
+        if self.dry_run:
+            print(f"\n{'='*60}")
+            print(f"LEADERBOARD: {label}")
+            self._print_channels(channels)
+            print(f"{'='*60}")
+            print(json.dumps(json.loads(card), indent=2))
+            print(f"{'='*60}\n")
+            return True
+        return self._enqueue(card, [], f"leaderboard: {label}", channels)
+    
+    def flush(self, timeout=None):
+        """Wait until every queued card that is due has been sent (or has failed); False on timeout"""
+        if self.dry_run or not self.send:
+            return True
+        drained = self.sender.drain(timeout=timeout)
+        counts = self._outbox_counts()
+        if counts:
+            log.warning(f"Outbox: {counts.get('pending', 0)} message(s) waiting to be retried, "
+                        f"{counts.get('dead', 0)} dead-lettered (see outbox.py --list)", **counts)
+        return drained
+    
+    def _outbox_counts(self):
+        counts = self.outbox.counts()
+        for status in ('pending', 'dead'):
+            metrics.OUTBOX_MESSAGES.set(counts.get(status, 0), status=status)
+        return counts
+    
+    def close(self, timeout=None):
+        """Flush the outbox and stop the sender (a shared sender is left running with
+        the run's cards still queued)"""
+        if not self.owns_sender:
+            self._outbox_counts()
+            return True
+        try:
+            return self.flush(timeout=timeout)
+        finally:
+            self.sender.stop()
     
     def post_summary(self, activities, athlete_name=None):
         """Post a summary card with all activities"""
         if not activities:
             # Skip posting when there are no activities
-            print("No activities in the last 24 hours - skipping post")
-            return
+            log.info("No new activities since last sync - skipping post")
+            return True
         
+        if config.TEAMS_DIGEST and len(activities) > 1:
+            # Pack all activities into as few messages as possible
+            return self.post_digest(activities, athlete_name=athlete_name)
         # Post individual activity cards
-        self.post_activities(activities, athlete_name=athlete_name)
+        return self.post_activities(activities, athlete_name=athlete_name)
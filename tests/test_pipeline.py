@@ -0,0 +1,63 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from activity_record import ActivityRecord
+from pipeline import ActivityPipeline
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def summaries(count):
+    return [ActivityRecord(id=i, name=f"Run {i}", type='Run', start_date=START + timedelta(minutes=i),
+                           start_date_local=START + timedelta(minutes=i)) for i in range(1, count + 1)]
+
+
+class FakeStrava:
+    cache = None
+
+    def get_activity_details(self, activity_id, priority=None):
+        return next(s for s in summaries(activity_id) if s.id == activity_id)
+
+    def resolve_photo(self, activity):
+        return activity
+
+
+class RaisingTeams:
+    """Poster that raises for the given activity ids (every activity by default)"""
+
+    def __init__(self, failing=None):
+        self.failing = failing
+        self.posted = []
+
+    def unposted_channels(self, activity):
+        return ['default']
+
+    def post_activity(self, activity, athlete_name=None):
+        if self.failing is None or activity.id in self.failing:
+            raise OSError("disk full")
+        self.posted.append(activity.id)
+        return True
+
+
+def run_with_timeout(pipeline, items, seconds=20):
+    thread = threading.Thread(target=pipeline.run, args=(items,), daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive(), "run() hung"
+
+
+def test_raising_poster_does_not_hang_run():
+    pipeline = ActivityPipeline(FakeStrava(), RaisingTeams(), fetch_workers=2, post_workers=2, queue_size=4)
+    run_with_timeout(pipeline, summaries(200))
+    assert pipeline.failed == 200
+    assert pipeline.posted == 0
+    assert pipeline.high_water_mark is None
+
+
+def test_post_failure_holds_high_water_mark_back():
+    items = summaries(200)
+    teams = RaisingTeams(failing={50})
+    pipeline = ActivityPipeline(FakeStrava(), teams, fetch_workers=2, post_workers=2, queue_size=4)
+    run_with_timeout(pipeline, items)
+    assert pipeline.failed == 1
+    assert pipeline.posted == 199
+    assert pipeline.high_water_mark == items[48].start_date.timestamp()
@@ -0,0 +1,61 @@
+import time
+from datetime import datetime, timedelta, timezone
+import pytest
+import config
+import main
+import sync_cursor
+from sync_cursor import SyncCursor
+
+
+@pytest.fixture
+def state_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'STATE_DB', str(tmp_path / 'state.db'))
+    monkeypatch.setattr(config, 'TEAMS_DIGEST', False)
+
+
+class QuietStrava:
+    """An athlete with no activities; remembers what each run asked for"""
+    sync_key = 'self'
+    cache = None
+
+    def __init__(self):
+        self.requested_after = []
+
+    def get_athlete_name(self):
+        return "Quiet Athlete"
+
+    def iter_summaries_after(self, after, on_page=None):
+        self.requested_after.append(after)
+        return iter(())
+
+
+class NoTeams:
+    dry_run = False
+
+
+def test_empty_run_saves_the_run_start(state_db):
+    cursor = SyncCursor()
+    before = time.time()
+    main.post_athlete_activities(QuietStrava(), NoTeams(), cursor)
+    assert before <= cursor.get('self') <= time.time()
+
+
+def test_empty_run_then_gap_longer_than_lookback_resumes_from_the_mark(state_db, monkeypatch):
+    cursor = SyncCursor()
+    strava = QuietStrava()
+    main.post_athlete_activities(strava, NoTeams(), cursor)
+    mark = datetime.fromtimestamp(cursor.get('self'), timezone.utc)
+
+    # The next run comes after an outage longer than LOOKBACK_HOURS
+    later = mark + timedelta(hours=config.LOOKBACK_HOURS + 48)
+
+    class Later(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return later
+
+    monkeypatch.setattr(sync_cursor, 'datetime', Later)
+    main.post_athlete_activities(strava, NoTeams(), cursor)
+    after = strava.requested_after[-1]
+    assert after == mark - timedelta(hours=config.SYNC_OVERLAP_HOURS)
+    assert after != later - timedelta(hours=config.LOOKBACK_HOURS)
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+import config
+import log
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows: only threads in this process are serialized there
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path, exclusive=True):
+    """Lock a token file against other processes (via a `.lock` file next to it)"""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_json(path):
+    """Read a token file; a missing or empty one (e.g. the Docker placeholder) reads as {}"""
+    if not os.path.exists(path):
+        return {}
+    if not os.path.isfile(path):
+        # e.g. the directory Docker creates for a bind mount of a missing host file
+        log.warning(f"Token file {path} is not a file - reading it as empty")
+        return {}
+    with open(path, 'r') as f:
+        content = f.read()
+    return json.loads(content) if content.strip() else {}
+
+
+def write_json(path, data):
+    """Write a token file atomically, so a crash never leaves it half-written"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # A Docker bind-mounted file can't be replaced; rewrite it in place instead
+        # (still safe against other writers, which hold the same lock)
+        with open(tmp_path, 'r') as src, open(path, 'w') as dst:
+            dst.write(src.read())
+        os.remove(tmp_path)
+
+
+def _token_fields(token_response):
+    return {
+        'access_token': token_response['access_token'],
+        'refresh_token': token_response['refresh_token'],
+        'expires_at': token_response['expires_at']
+    }
+
+
+class TokenFile:
+    """Strava tokens for the single athlete of config.TOKEN_FILE"""
+
+    def __init__(self, path=None):
+        self.path = path or config.TOKEN_FILE
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Get the saved tokens (None if there are none yet)"""
+        with self._lock, file_lock(self.path, exclusive=False):
+            return read_json(self.path) or None
+
+    def save(self, token_response):
+        with self._lock, file_lock(self.path):
+            write_json(self.path, _token_fields(token_response))
+
+
+class TokenStore:
+    """Strava tokens for every enrolled athlete, keyed by athlete id"""
+
+    def __init__(self, path=None):
+        self.path = path or config.ATHLETE_TOKEN_FILE
+        self._lock = threading.Lock()
+
+    def athlete_ids(self):
+        """Ids of all enrolled athletes"""
+        with self._lock, file_lock(self.path, exclusive=False):
+            return list(read_json(self.path).keys())
+
+    def get(self, athlete_id):
+        """Get the saved tokens for an athlete (None if not enrolled)"""
+        with self._lock, file_lock(self.path, exclusive=False):
+            return read_json(self.path).get(str(athlete_id))
+
+    def save(self, athlete_id, token_response, name=None):
+        """Save (or update) the tokens for an athlete"""
+        # Read-modify-write under one lock, so concurrent refreshes never drop each other
+        with self._lock, file_lock(self.path):
+            data = read_json(self.path)
+            entry = data.get(str(athlete_id), {})
+            entry.update(_token_fields(token_response))
+            if name:
+                entry['name'] = name
+            data[str(athlete_id)] = entry
+            write_json(self.path, data)
+
+    def remove(self, athlete_id):
+        """Remove an athlete from the store"""
+        with self._lock, file_lock(self.path):
+            data = read_json(self.path)
+            if data.pop(str(athlete_id), None) is not None:
+                write_json(self.path, data)
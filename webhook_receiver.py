@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Event-driven mode: receives Strava push-subscription events and posts each new
+activity to Teams within seconds, instead of waiting for the cron schedule.
+
+    python3 main.py --webhook                              # run the receiver
+    python3 webhook_receiver.py --subscribe https://<host>/webhook
+    python3 webhook_receiver.py --send-test-event <activity_id> <athlete_id>
+"""
+
+import sys
+import threading
+import time
+import requests
+from flask import Flask, Response, jsonify, request
+import config
+import log
+import metrics
+from strava_client import forget_client, get_client
+from teams_poster import TeamsPoster
+from token_store import TokenStore
+
+app = Flask(__name__)
+processor = None
+
+
+class EventProcessor:
+    """Coalesces Strava events per activity and posts each activity once it settles.
+
+    Strava often sends a create followed by several updates (title, photos) within
+    seconds, so every event only (re)starts a short timer for its activity; the
+    activity is fetched and posted once, when the timer runs out.
+    """
+
+    def __init__(self, teams, token_store, coalesce_seconds=None):
+        self.teams = teams
+        self.token_store = token_store
+        self.coalesce_seconds = config.WEBHOOK_COALESCE_SECONDS if coalesce_seconds is None else coalesce_seconds
+        self.pending = {}
+        self._condition = threading.Condition()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, event):
+        """Queue an event from Strava (must return quickly: Strava expects a reply within 2s)"""
+        object_type = event.get('object_type')
+        aspect_type = event.get('aspect_type')
+        owner_id = event.get('owner_id')
+        metrics.WEBHOOK_EVENTS.inc(object_type=object_type, aspect_type=aspect_type)
+
+        if object_type == 'athlete':
+            # An athlete revoking access is sent as an update with authorized=false
+            if event.get('updates', {}).get('authorized') == 'false' and self.token_store.get(owner_id):
+                log.info(f"Athlete {owner_id} deauthorized - removing from team", athlete_id=owner_id)
+                self.token_store.remove(owner_id)
+                forget_client(owner_id)
+            return
+
+        if object_type != 'activity':
+            return
+
+        activity_id = event.get('object_id')
+        with self._condition:
+            if aspect_type == 'delete':
+                self.pending.pop(activity_id, None)
+                return
+            self.pending[activity_id] = (owner_id, time.monotonic() + self.coalesce_seconds)
+            self._condition.notify()
+
+    def _client_for(self, owner_id):
+        if self.token_store.athlete_ids():
+            return get_client(owner_id, token_store=self.token_store)
+        return get_client()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self.pending:
+                    self._condition.wait()
+                now = time.monotonic()
+                due = [(activity_id, owner_id) for activity_id, (owner_id, due_at) in self.pending.items()
+                       if due_at <= now]
+                if not due:
+                    self._condition.wait(min(due_at for _, due_at in self.pending.values()) - now)
+                    continue
+                for activity_id, _ in due:
+                    del self.pending[activity_id]
+
+            for activity_id, owner_id in due:
+                self._process(activity_id, owner_id)
+
+    def _process(self, activity_id, owner_id):
+        # Updates to an activity already posted (to the channels it was routed to) need no
+        # detail fetch
+        if self.teams.posted_anywhere([activity_id]):
+            return
+        try:
+            strava = self._client_for(owner_id)
+            # The event means the activity just changed, so skip the cache
+            activity = strava.get_activity_details(activity_id, refresh=True)
+            self.teams.post_activity(activity, athlete_name=strava.get_athlete_name())
+        except Exception as e:
+            log.error(f"✗ Error handling event for activity {activity_id}: {str(e)}",
+                      activity_id=activity_id, athlete_id=owner_id)
+            metrics.ACTIVITY_FAILURES.inc(stage='webhook')
+
+
+@app.route('/webhook', methods=['GET'])
+def verify_subscription():
+    """Answer Strava's subscription validation request"""
+    if request.args.get('hub.verify_token') != config.STRAVA_WEBHOOK_VERIFY_TOKEN:
+        return "Invalid verify token", 403
+    return jsonify({'hub.challenge': request.args.get('hub.challenge')})
+
+
+@app.route('/webhook', methods=['POST'])
+def receive_event():
+    """Accept a push event from Strava"""
+    event = request.get_json(silent=True)
+    if not event:
+        return "Invalid event", 400
+    processor.submit(event)
+    return "", 200
+
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/photos/<name>', methods=['GET'])
+def serve_photo(name):
+    """Cached card photos (see photos.py); names are content hashes, so never change"""
+    photo = processor.teams.photos.read(name)
+    if photo is None:
+        return "Not found", 404
+    body, content_type = photo
+    return Response(body, content_type=content_type,
+                    headers={'Cache-Control': 'public, max-age=31536000, immutable'})
+
+
+def run(dry_run=False):
+    """Start the event receiver (blocks)"""
+    global processor
+    processor = EventProcessor(TeamsPoster(dry_run=dry_run), TokenStore())
+
+    log.banner("Strava Teams Bot Started (webhook mode)",
+               f"Listening for Strava events on port {config.WEBHOOK_PORT} at /webhook",
+               "Metrics at /metrics and cached photos at /photos on the same port")
+    app.run(host='0.0.0.0', port=config.WEBHOOK_PORT, debug=False)
+
+
+def subscribe(callback_url):
+    """Register the push subscription with Strava (one per application)"""
+    subscription = get_client().client.create_subscription(
+        client_id=config.STRAVA_CLIENT_ID,
+        client_secret=config.STRAVA_CLIENT_SECRET,
+        callback_url=callback_url,
+        verify_token=config.STRAVA_WEBHOOK_VERIFY_TOKEN
+    )
+    print(f"✓ Subscribed (subscription id {subscription.id}) - events go to {callback_url}")
+
+
+def send_test_event(activity_id, owner_id, url=None, aspect_type='create'):
+    """Send a fake Strava event to a running receiver, for local testing"""
+    url = url or f"http://localhost:{config.WEBHOOK_PORT}/webhook"
+    event = {
+        'aspect_type': aspect_type,
+        'event_time': int(time.time()),
+        'object_id': int(activity_id),
+        'object_type': 'activity',
+        'owner_id': int(owner_id),
+        'subscription_id': 0,
+        'updates': {}
+    }
+    response = requests.post(url, json=event, timeout=10)
+    print(f"Sent {aspect_type} event for activity {activity_id} - Status: {response.status_code}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--subscribe':
+        subscribe(sys.argv[2])
+    elif len(sys.argv) > 3 and sys.argv[1] == '--send-test-event':
+        send_test_event(sys.argv[2], sys.argv[3], *sys.argv[4:5])
+    else:
+        print(__doc__)
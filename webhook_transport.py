@@ -0,0 +1,125 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+import config
+import log
+import metrics
+import profiling
+from http_session import Session
+from routing import DEFAULT_CHANNEL
+
+
+# Status codes worth retrying: throttled or a transient server-side failure
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Client-side throttle: allows `rate` requests per second with bursts up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Drain the bucket so nothing is sent for `seconds` (e.g. after a Retry-After)"""
+        with self._lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+def _retry_after_seconds(response):
+    """Parse a Retry-After header (seconds or HTTP date), None if absent or invalid"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class WebhookTransport:
+    """Pooled, throttled and retrying HTTP transport for posting to a Teams webhook.
+
+    Teams throttles each webhook separately, so every channel gets its own transport
+    (connection pool and token bucket).
+    """
+
+    def __init__(self, channel=DEFAULT_CHANNEL):
+        self.channel = channel
+        self.session = Session()
+        adapter = HTTPAdapter(pool_maxsize=10)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Content-Type'] = 'application/json'
+        self.bucket = TokenBucket(config.TEAMS_RATE_PER_SECOND, config.TEAMS_RATE_BURST)
+        self.timeout = config.TEAMS_TIMEOUT_SECONDS
+        self.max_retries = config.TEAMS_MAX_RETRIES
+
+    def _backoff(self, attempt):
+        # Exponential backoff with full jitter, capped at a minute
+        return random.uniform(0, min(60, 2 ** attempt))
+
+    def post(self, url, payload):
+        """POST a JSON payload (a dict, or already-encoded bytes), retrying throttled, 5xx
+        and network failures.
+
+        Returns the final response; raises the last network error if every attempt failed.
+        """
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                with metrics.TEAMS_REQUEST_SECONDS.time(channel=self.channel), \
+                        profiling.span('requests.post', channel=self.channel, attempt=attempt) as stage:
+                    if isinstance(payload, bytes):
+                        response = self.session.post(url, data=payload, timeout=self.timeout)
+                    else:
+                        response = self.session.post(url, json=payload, timeout=self.timeout)
+                    stage.set(status=response.status_code)
+            except (requests.ConnectionError, requests.Timeout):
+                metrics.TEAMS_REQUESTS.inc(channel=self.channel, status='error')
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+
+            metrics.TEAMS_REQUESTS.inc(channel=self.channel, status=response.status_code)
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                return response
+
+            delay = _retry_after_seconds(response)
+            if delay is None:
+                delay = self._backoff(attempt)
+            log.warning(f"  Teams returned {response.status_code}, retrying in {delay:.1f}s...",
+                        channel=self.channel, status=response.status_code, retry_in=round(delay, 1))
+            if response.status_code == 429:
+                # Throttling applies to the whole webhook, so hold back every sender;
+                # the next acquire() waits out the delay
+                self.bucket.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1